@@ -0,0 +1,20 @@
+from trytond.pool import Pool
+from .training import *
+
+
+def register():
+    Pool.register(
+        TrainingGroup,
+        TrainingSession,
+        TrainingParticipation,
+        TrainingSeanse,
+        TrainingResource,
+        TrainingWaitlist,
+        TrainingRecomputeQueue,
+        TrainingEvent,
+        TrainingCourseClosure,
+        Course,
+        SubscriptionLine,
+        ParticipationStakeholder,
+        Location,
+        module='training_participation', type_='model')
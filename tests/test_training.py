@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+import sys
+import os
+DIR = os.path.abspath(os.path.normpath(os.path.join(__file__,
+    '..', '..', '..', '..', '..', 'trytond')))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+
+import unittest
+import sqlite3
+from datetime import datetime, timedelta, date
+from collections import namedtuple
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT, test_view,\
+    test_depends
+from trytond.transaction import Transaction
+from trytond.config import CONFIG
+from trytond import backend
+from trytond.modules.training_participation import training
+from trytond.modules.training_participation.training import _bulk_insert, query_budget, \
+    _invalidate_available_seats, _invalidate_prefetched, _report_fetchall, \
+    _report_database, _overlaps, _next_working_day, _to_datetime, _bulk_update
+
+# Maximum number of queries of the key operations, they must not depend on
+# the number of records so they are the same for both fixture sizes
+QUERY_BUDGETS = {
+    'training.session._participant_count': 1,
+    'training.session._confirmed_subscriptions_count': 1,
+    'training.session._draft_subscriptions_count': 1,
+    # The seances of the sessions, their counts and their thresholds
+    'training.session.get_available_seats': 3,
+    'training.session.check_workflow_open': 1,
+    'training.session.check_workflow_close': 1,
+    'training.seance._participant_count': 1,
+    'training.seance._draft_seats_compute': 1,
+    # The counts and the read of the thresholds
+    'training.seance.get_available_seats': 2,
+    'training.seance.check_workflow_confirm': 1,
+    'training.seance.check_workflow_cancel': 1,
+    'training.seance.search_job': 1,
+    # One read by model of the path participation, subscription line, job,
+    # contact and partner
+    'training.participation.name_get': 5,
+    }
+
+# Number of sessions of the small and of the large fixtures, the large one
+# stays under the IN_MAX of the cursors so the reads are not split
+SIZES = (2, 20)
+SEANCES = 4
+LINES = 10
+# The lecturer searched by search_job, the query only filters on it
+JOB_ID = 1
+# The allocations only read the ids of the subscription lines
+Line = namedtuple('Line', ['id'])
+
+
+class TrainingTestCase(unittest.TestCase):
+    '''
+    Test Training module.
+    '''
+
+    def setUp(self):
+        trytond.tests.test_tryton.install_module('training_participation')
+        self.session = POOL.get('training.session')
+        self.seance = POOL.get('training.seance')
+        self.participation = POOL.get('training.participation')
+
+    def test0005views(self):
+        '''
+        Test views.
+        '''
+        test_view('training_participation')
+
+    def test0006depends(self):
+        '''
+        Test depends.
+        '''
+        test_depends()
+
+    def create_fixtures(self, cursor, size):
+        '''
+        Create size sessions with their seances, subscription lines and
+        participations and return their ids.
+        '''
+        now = datetime.now()
+        start = now + timedelta(days=30)
+        audit = [USER, now]
+
+        session_ids = _bulk_insert(cursor, 'training_session',
+            ['name', 'date', 'state', 'min_limit', 'max_limit', 'manual', 'user_id', 'create_uid', 'create_date'],
+            [['Session %d' % i, start, 'opened', 1, 100, False, USER] + audit for i in range(size)])
+        seance_ids = _bulk_insert(cursor, 'training_seance',
+            ['name', 'date', 'duration', 'state', 'kind', 'min_limit', 'max_limit', 'manual',
+                'user_id', 'create_uid', 'create_date'],
+            [['Seance %d' % i, start + timedelta(days=i % SEANCES), 2.0, 'opened', 'standard', 1, 100, False,
+                USER] + audit for i in range(size * SEANCES)])
+        _bulk_insert(cursor, 'training_session_seance_rel', ['session_id', 'seance_id'],
+            [[session_ids[i // SEANCES], seance_id] for i, seance_id in enumerate(seance_ids)],
+            returning=False)
+
+        line_ids = _bulk_insert(cursor, 'training_subscription_line',
+            ['session_id', 'state', 'create_uid', 'create_date'],
+            [[session_id, i % 3 and 'confirmed' or 'draft'] + audit
+                for session_id in session_ids for i in range(LINES)])
+        participation_ids = _bulk_insert(cursor, 'training_participation',
+            ['seance_id', 'subscription_line_id', 'present', 'create_uid', 'create_date'],
+            [[seance_ids[session_index * SEANCES + j], line_id, False] + audit
+                for session_index, session_id in enumerate(session_ids)
+                for line_id in line_ids[session_index * LINES:(session_index + 1) * LINES]
+                for j in range(SEANCES)])
+        return session_ids, seance_ids, participation_ids
+
+    def operations(self, session_ids, seance_ids, participation_ids):
+        search_ctx = dict(CONTEXT, job_id=JOB_ID, request_session_id=session_ids[0])
+        return [
+            ('training.session._participant_count',
+                lambda c: self.session._participant_count(c, USER, session_ids, None, None)),
+            ('training.session._confirmed_subscriptions_count',
+                lambda c: self.session._confirmed_subscriptions_count(c, USER, session_ids, None, None)),
+            ('training.session._draft_subscriptions_count',
+                lambda c: self.session._draft_subscriptions_count(c, USER, session_ids, None, None)),
+            ('training.session.get_available_seats',
+                lambda c: self.session.get_available_seats(c, USER, session_ids)),
+            ('training.session.check_workflow_open',
+                lambda c: self.session.check_workflow_open(c, USER, session_ids)),
+            ('training.session.check_workflow_close',
+                lambda c: self.session.check_workflow_close(c, USER, session_ids)),
+            ('training.seance._participant_count',
+                lambda c: self.seance._participant_count(c, USER, seance_ids, None, None)),
+            ('training.seance._draft_seats_compute',
+                lambda c: self.seance._draft_seats_compute(c, USER, seance_ids, None, None)),
+            ('training.seance.get_available_seats',
+                lambda c: self.seance.get_available_seats(c, USER, seance_ids)),
+            ('training.seance.check_workflow_confirm',
+                lambda c: self.seance.check_workflow_confirm(c, USER, seance_ids)),
+            ('training.seance.check_workflow_cancel',
+                lambda c: self.seance.check_workflow_cancel(c, USER, seance_ids)),
+            ('training.seance.search_job',
+                lambda c: self.seance.search(c, USER, [], context=search_ctx)),
+            ('training.participation.name_get',
+                lambda c: self.participation.name_get(c, USER, participation_ids)),
+            ]
+
+    def count_queries(self, size):
+        '''
+        Return the number of queries of each operation on fixtures of size
+        sessions, failing when one is over its budget.
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as transaction:
+            cursor = transaction.cursor
+            ids = self.create_fixtures(cursor, size)
+            res = {}
+            for name, operation in self.operations(*ids):
+                _invalidate_available_seats()
+                with query_budget(cursor, QUERY_BUDGETS[name], name) as counting:
+                    operation(counting)
+                res[name] = counting.queries
+            cursor.rollback()
+        return res
+
+    def test0010query_budgets(self):
+        '''
+        Test the key operations run a constant number of queries.
+        '''
+        small, large = [self.count_queries(size) for size in SIZES]
+        for name in sorted(QUERY_BUDGETS):
+            self.assertEqual(small[name], large[name],
+                '%s executed %d queries for %d sessions and %d for %d'
+                % (name, small[name], SIZES[0], large[name], SIZES[1]))
+
+    def test0020report_database(self):
+        '''
+        Test the reads go to the reporting database and fall back to the
+        primary when it is unreachable, stale or the transaction wrote.
+        '''
+        if backend.name() != 'sqlite':
+            return
+        name = 'training_report_test'
+        path = os.path.join(CONFIG['data_path'], name + '.sqlite')
+        connection = sqlite3.connect(path)
+        connection.execute("CREATE TABLE training_report_probe (value VARCHAR)")
+        connection.execute("INSERT INTO training_report_probe VALUES ('report')")
+        connection.commit()
+        connection.close()
+        config = dict((k, CONFIG.get(k)) for k in ('training_report_db', 'training_report_staleness'))
+        report_lag = training._report_lag
+        query = "SELECT value FROM training_report_probe"
+        try:
+            with Transaction().start(DB_NAME, USER, context=CONTEXT) as transaction:
+                cursor = transaction.cursor
+                cursor.execute("CREATE TABLE training_report_probe (value VARCHAR)")
+                cursor.execute("INSERT INTO training_report_probe VALUES ('primary')")
+
+                CONFIG['training_report_db'] = name
+                CONFIG['training_report_staleness'] = 30
+                training._report_lags.clear()
+                self.assertEqual(_report_fetchall(cursor, query, []), [('report',)])
+                self.assertTrue(_report_database(name) is _report_database(name))
+
+                # Stale
+                training._report_lags.clear()
+                training._report_lag = lambda cursor: 60.0
+                self.assertEqual(_report_fetchall(cursor, query, []), [('primary',)])
+                training._report_lag = report_lag
+                training._report_lags.clear()
+
+                # Unreachable
+                CONFIG['training_report_db'] = 'training_report_missing'
+                self.assertEqual(_report_fetchall(cursor, query, []), [('primary',)])
+                CONFIG['training_report_db'] = name
+
+                # Written by the transaction
+                _invalidate_prefetched(cursor)
+                self.assertEqual(_report_fetchall(cursor, query, []), [('primary',)])
+                cursor.rollback()
+        finally:
+            training._report_lag = report_lag
+            training._report_lags.clear()
+            training._report_databases.__dict__.clear()
+            for key, value in config.items():
+                if value is None:
+                    CONFIG.options.pop(key, None)
+                else:
+                    CONFIG[key] = value
+            os.remove(path)
+
+    def test0030overlaps(self):
+        '''
+        Test the sweep returns the overlapping intervals only.
+        '''
+        day = datetime(2030, 3, 4)
+        intervals = [
+            (day + timedelta(hours=9), day + timedelta(hours=11), 'a'),
+            (day + timedelta(hours=10), day + timedelta(hours=12), 'b'),
+            # Starts when a ends
+            (day + timedelta(hours=11), day + timedelta(hours=13), 'c'),
+            (day + timedelta(hours=14), day + timedelta(hours=15), 'd'),
+            ]
+        self.assertEqual(sorted(_overlaps(intervals)), [('a', 'b'), ('b', 'c')])
+        self.assertEqual(list(_overlaps([])), [])
+
+    def test0040next_working_day(self):
+        '''
+        Test the dates are moved after the holiday periods, following the
+        periods which are next to each other.
+        '''
+        periods = [(date(2030, 12, 27), date(2030, 12, 27)),
+            (date(2030, 12, 24), date(2030, 12, 26))]
+        self.assertEqual(_next_working_day(datetime(2030, 12, 25, 9, 30), periods),
+            datetime(2030, 12, 28, 9, 30))
+        self.assertEqual(_next_working_day(datetime(2030, 12, 23, 9, 30), periods),
+            datetime(2030, 12, 23, 9, 30))
+
+    def create_session(self, cursor, start, seances):
+        '''
+        Create an opened session starting at start with the seances given as
+        (date, duration, max limit) and return its id and the seance ids.
+        '''
+        audit = [USER, datetime.now()]
+        session_id, = _bulk_insert(cursor, 'training_session',
+            ['name', 'date', 'state', 'min_limit', 'max_limit', 'manual', 'user_id', 'create_uid', 'create_date'],
+            [['Session', start, 'opened', 1, 100, False, USER] + audit])
+        seance_ids = _bulk_insert(cursor, 'training_seance',
+            ['name', 'date', 'duration', 'state', 'kind', 'min_limit', 'max_limit', 'manual',
+                'user_id', 'create_uid', 'create_date'],
+            [['Seance %d' % i, seance_date, duration, 'opened', 'standard', 0, max_limit, False,
+                USER] + audit for i, (seance_date, duration, max_limit) in enumerate(seances)])
+        _bulk_insert(cursor, 'training_session_seance_rel', ['session_id', 'seance_id'],
+            [[session_id, seance_id] for seance_id in seance_ids], returning=False)
+        return session_id, seance_ids
+
+    def test0050allocate_groups(self):
+        '''
+        Test least_loaded fills the emptiest group first and round_robin
+        alternates, both skipping the full groups.
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as transaction:
+            cursor = transaction.cursor
+            audit = [USER, datetime.now()]
+            start = datetime(2030, 3, 4, 9)
+            session_id, seance_ids = self.create_session(cursor, start,
+                [(start + timedelta(days=i), 2.0, 3) for i in range(4)])
+            group_ids = _bulk_insert(cursor, 'training_group', ['name', 'session_id', 'create_uid', 'create_date'],
+                [['Class %d' % i, session_id] + audit for i in range(2)])
+            first, second = group_ids
+            _bulk_update(cursor, 'training_seance', 'group_id',
+                dict(zip(seance_ids, [first, first, second, second])), USER)
+
+            # Two of the three seats of the first group are taken
+            line_ids = _bulk_insert(cursor, 'training_subscription_line',
+                ['session_id', 'state', 'create_uid', 'create_date'],
+                [[session_id, 'confirmed'] + audit for i in range(6)])
+            _bulk_insert(cursor, 'training_participation',
+                ['seance_id', 'subscription_line_id', 'present', 'create_uid', 'create_date'],
+                [[seance_id, line_id, False] + audit
+                    for line_id in line_ids[:2] for seance_id in seance_ids[:2]],
+                returning=False)
+            lines = [Line(x) for x in line_ids[2:]]
+
+            allocation = self.session.allocate_groups(cursor, USER, session_id, lines, mode='least_loaded')
+            self.assertEqual([allocation[x.id] for x in lines], [second, second, first, second])
+            allocation = self.session.allocate_groups(cursor, USER, session_id, lines, mode='round_robin')
+            self.assertEqual([allocation[x.id] for x in lines], [first, second, second, second])
+            cursor.rollback()
+
+    def test0060plan_resources(self):
+        '''
+        Test the sweep gives each seance the smallest free room large enough
+        and reuses the rooms once their seance is over.
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as transaction:
+            cursor = transaction.cursor
+            audit = [USER, datetime.now()]
+            small, large = _bulk_insert(cursor, 'training_resource',
+                ['name', 'kind', 'capacity', 'active', 'create_uid', 'create_date'],
+                [['Small', 'room', 10, True] + audit, ['Large', 'room', 30, True] + audit])
+            start = datetime(2030, 3, 4, 9)
+            _session_id, seance_ids = self.create_session(cursor, start, [
+                (start, 2.0, 20),
+                (start + timedelta(hours=1), 2.0, 5),
+                # Both rooms are taken
+                (start + timedelta(hours=1, minutes=30), 1.0, 5),
+                # The large room is free again
+                (start + timedelta(hours=2), 2.0, 25),
+                ])
+            res = self.seance.plan_resources(cursor, USER, seance_ids, write=False)
+            self.assertEqual(res['assignment'], {
+                seance_ids[0]: large,
+                seance_ids[1]: small,
+                seance_ids[3]: large,
+                })
+            self.assertEqual(res['unassigned'], [seance_ids[2]])
+            cursor.rollback()
+
+    def test0070reschedule_compress(self):
+        '''
+        Test compress packs the seance days on consecutive days from the new
+        start, keeping the seances of a same day together and their times.
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as transaction:
+            cursor = transaction.cursor
+            start = datetime(2030, 3, 4, 9)
+            session_id, seance_ids = self.create_session(cursor, start, [
+                (start, 2.0, 10),
+                (start + timedelta(days=3), 2.0, 10),
+                (start + timedelta(days=3, hours=5), 2.0, 10),
+                (start + timedelta(days=7), 2.0, 10),
+                ])
+            new_start = datetime(2030, 4, 1, 9)
+            self.session.reschedule(cursor, USER, [session_id], start=new_start, compress=True)
+
+            cursor.execute("SELECT date FROM training_session WHERE id = %s", (session_id,))
+            self.assertEqual(_to_datetime(cursor.fetchone()[0]), new_start)
+            cursor.execute("SELECT id, date FROM training_seance "
+                "WHERE id IN (" + ",".join(['%s'] * len(seance_ids)) + ")", seance_ids)
+            dates = dict((x, _to_datetime(d)) for x, d in cursor.fetchall())
+            self.assertEqual([dates[x] for x in seance_ids], [
+                new_start,
+                new_start + timedelta(days=1),
+                new_start + timedelta(days=1, hours=5),
+                new_start + timedelta(days=2),
+                ])
+            cursor.rollback()
+
+
+def suite():
+    suite = trytond.tests.test_tryton.suite()
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        TrainingTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -3,21 +3,49 @@
 from decimal import Decimal
 from datetime import datetime, timedelta, date
 import operator
+import time
+import heapq
+import bisect
+import functools
+import weakref
+import json
+import logging
+import threading
+import csv
+import os
+import shutil
+import zipfile
+import base64
+import multiprocessing
+from collections import deque
+from contextlib import contextmanager
 from itertools import izip, groupby
 from sql import Column, Literal
 from sql.aggregate import Sum
 from sql.conditionals import Coalesce
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 from trytond.model import Workflow, ModelView, ModelSQL, fields
+from trytond.cache import Cache
 from trytond.wizard import Wizard, StateView, StateAction, StateTransition, \
     Button
 from trytond.report import Report
 from trytond.tools import reduce_ids
 from trytond.pyson import Eval, PYSONEncoder, Date, Id
 from trytond.transaction import Transaction
-from trytond.pool import Pool
+from trytond.pool import Pool, PoolMeta
+from trytond.config import CONFIG
 from trytond import backend
 
+__all__ = ['TrainingGroup', 'TrainingSession', 'TrainingParticipation',
+    'TrainingSeanse', 'TrainingResource', 'TrainingWaitlist',
+    'TrainingRecomputeQueue', 'TrainingEvent', 'TrainingCourseClosure',
+    'Course', 'SubscriptionLine', 'ParticipationStakeholder', 'Location']
+
 STATES = {
     'readonly': (Eval('state') != 'draft'),
 }
@@ -34,6 +62,895 @@ GUARANTEE = [
     ('letter', 'Letter'),
     ]
 
+# Seconds during which a computed number of available seats is served from
+# the cache without hitting the database
+AVAILABLE_SEATS_TTL = 5
+
+# Fields whose modification changes the number of available seats
+SEATS_FIELDS = ('state', 'max_limit', 'manual', 'participant_count_manual',
+    'seance_ids', 'session_ids')
+
+
+def _cached_seats(cache, ids, compute):
+    '''
+    Return a dictionary of available seats for ids using the cache and
+    calling compute once for all the missing or expired ids.
+    '''
+    now = time.time()
+    res = {}
+    missing = []
+    for id_ in ids:
+        cached = cache.get(id_)
+        if cached is not None and now - cached[0] < AVAILABLE_SEATS_TTL:
+            res[id_] = cached[1]
+        else:
+            missing.append(id_)
+    if missing:
+        for id_, seats in compute(missing).items():
+            cache.set(id_, (now, seats))
+            res[id_] = seats
+    return res
+
+
+# Internal location of the procurements, cleared when a location changes
+_internal_location_cache = Cache('training.internal_location', context=False)
+
+
+def _get_internal_location(pool, cr, uid, context=None):
+    location_id = _internal_location_cache.get('internal')
+    if location_id is None:
+        location_id = pool.get('stock.location').search(cr, uid, [('usage', '=', 'internal')], context=context)[0]
+        _internal_location_cache.set('internal', location_id)
+    return location_id
+
+
+def _invalidate_available_seats():
+    TrainingSession._available_seats_cache.clear()
+    TrainingSeanse._available_seats_cache.clear()
+
+
+# Prefetch caches by cursor so they never outlive the transaction
+_prefetched = weakref.WeakKeyDictionary()
+
+logger = logging.getLogger('trytond.modules.training.profiling')
+
+# The session signals collected by cursor while the scheduler runs, to send
+# each of them once by chunk
+_deferred_session_signals = weakref.WeakKeyDictionary()
+
+
+class CountingCursor(object):
+    '''
+    Cursor proxy counting the executed queries and the fetched rows.
+    '''
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.queries = 0
+        self.rows = 0
+
+    def execute(self, *args, **kwargs):
+        self.queries += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self.rows += 1
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self._cursor.fetchmany(*args, **kwargs)
+        self.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self.rows += len(rows)
+        return rows
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+def _real_cursor(cr):
+    while isinstance(cr, CountingCursor):
+        cr = cr._cursor
+    return cr
+
+
+# Statistics by method: calls, seconds, queries, rows
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+def profiling_enabled():
+    return str(CONFIG.get('training_profiling', False)).lower() in ('1', 'true', 'yes')
+
+
+def instrumented(func):
+    '''
+    Decorate a method (self, cr, uid, ...) to record its time, queries and
+    fetched rows when training_profiling is set.
+    '''
+    @functools.wraps(func)
+    def wrapper(self, cr, uid, *args, **kwargs):
+        if not profiling_enabled():
+            return func(self, cr, uid, *args, **kwargs)
+
+        cursor = CountingCursor(cr)
+        start = time.time()
+        try:
+            return func(self, cursor, uid, *args, **kwargs)
+        finally:
+            duration = time.time() - start
+            name = '%s.%s' % (_model_name(self), func.__name__)
+            with _metrics_lock:
+                values = _metrics.setdefault(name, [0, 0.0, 0, 0])
+                values[0] += 1
+                values[1] += duration
+                values[2] += cursor.queries
+                values[3] += cursor.rows
+            logger.info(json.dumps({
+                        'method': name,
+                        'seconds': round(duration, 6),
+                        'queries': cursor.queries,
+                        'rows': cursor.rows,
+                        }))
+    return wrapper
+
+
+def export_metrics():
+    '''
+    Return the recorded statistics in the Prometheus text format.
+    '''
+    with _metrics_lock:
+        metrics = sorted((k, list(v)) for k, v in _metrics.items())
+    lines = []
+    for index, (metric, kind, help_) in enumerate([
+                ('training_method_calls_total', 'counter', 'Number of calls'),
+                ('training_method_seconds_total', 'counter', 'Wall time spent'),
+                ('training_method_queries_total', 'counter', 'SQL queries executed'),
+                ('training_method_rows_total', 'counter', 'Rows fetched'),
+                ]):
+        lines.append('# HELP %s %s' % (metric, help_))
+        lines.append('# TYPE %s %s' % (metric, kind))
+        for name, values in metrics:
+            lines.append('%s{method="%s"} %s' % (metric, name, values[index]))
+    return '\n'.join(lines) + '\n'
+
+
+def reset_metrics():
+    with _metrics_lock:
+        _metrics.clear()
+
+
+# Queries counting the participants, ids is replaced by the placeholders of
+# the record ids
+COUNTING_QUERIES = {
+    'training.session.participant_count': (
+        "SELECT ss.session_id, COUNT(DISTINCT(tsl.contact_id)) "
+        "FROM training_participation tp, training_subscription_line tsl, training_session_seance_rel ss "
+        "WHERE tp.subscription_line_id = tsl.id "
+        "AND ss.seance_id = tp.seance_id "
+        "AND ss.session_id IN (%(ids)s) "
+        "AND tsl.state IN ('confirmed', 'done') "
+        "GROUP BY ss.session_id"),
+    'training.session.confirmed_subscriptions': (
+        "SELECT session_id, COUNT(1) "
+        "FROM training_subscription_line "
+        "WHERE state IN ('confirmed', 'done') "
+        "AND session_id IN (%(ids)s) "
+        "GROUP BY session_id"),
+    'training.session.draft_subscriptions': (
+        "SELECT session_id, COUNT(1) "
+        "FROM training_subscription_line "
+        "WHERE state = 'draft' "
+        "AND session_id IN (%(ids)s) "
+        "GROUP BY session_id"),
+    'training.seance.participant_count': (
+        "SELECT tp.seance_id, COUNT(DISTINCT(tsl.contact_id)) "
+        "FROM training_participation tp, training_subscription_line tsl "
+        "WHERE tp.subscription_line_id = tsl.id "
+        "AND tp.seance_id IN (%(ids)s) "
+        "AND tsl.state IN ('confirmed', 'done') "
+        "GROUP BY tp.seance_id"),
+    'training.seance.draft_seats': (
+        "SELECT rel.seance_id, COUNT(1) "
+        "FROM training_subscription_line sl, training_session_seance_rel rel "
+        "WHERE sl.state = 'draft' "
+        "AND sl.session_id = rel.session_id "
+        "AND rel.seance_id IN (%(ids)s) "
+        "GROUP BY rel.seance_id"),
+    'training.seance.free_seats': (
+        "SELECT s.id, s.max_limit, s.manual, COUNT(tsl.id) "
+        "FROM training_seance s "
+        "LEFT JOIN training_participation tp ON tp.seance_id = s.id "
+        "LEFT JOIN training_subscription_line tsl ON tsl.id = tp.subscription_line_id "
+        "AND tsl.state != 'cancelled' "
+        "WHERE s.id IN (%(ids)s) "
+        "GROUP BY s.id, s.max_limit, s.manual"),
+    }
+
+
+def _counting_query(name, ids):
+    return COUNTING_QUERIES[name] % {'ids': ','.join(['%s'] * len(ids))}
+
+
+# Composite indexes of the hot joins as (table, name, columns, condition),
+# the partial ones cover the counts of the confirmed subscriptions
+INDEXES = [
+    ('training_subscription_line', 'training_subscription_line_session_state_idx',
+        ['session_id', 'state'], None),
+    ('training_subscription_line', 'training_subscription_line_confirmed_idx',
+        ['id', 'contact_id'], "state IN ('confirmed', 'done')"),
+    ('training_session_seance_rel', 'training_session_seance_rel_seance_session_idx',
+        ['seance_id', 'session_id'], None),
+    ('training_seance', 'training_seance_course_state_date_idx',
+        ['course_id', 'state', 'date'], None),
+    ('training_seance', 'training_seance_chain_position_idx',
+        ['chain_id', 'chain_position'], None),
+    ('training_seance', 'training_seance_state_date_idx',
+        ['state', 'date'], None),
+    ('training_event', 'training_event_txid_idx',
+        ['txid', 'id'], None),
+    ]
+
+# Indexes created by previous versions and no longer useful, the one on
+# (seance_id, subscription_line_id) duplicated the uniq_seance_sl constraint
+OBSOLETE_INDEXES = ['training_participation_seance_sl_idx']
+
+
+def _index_exists(cursor, name):
+    if backend.name() == 'postgresql':
+        cursor.execute('SELECT 1 FROM pg_indexes WHERE indexname = %s', (name,))
+    else:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = %s", (name,))
+    return bool(cursor.fetchone())
+
+
+def _create_indexes(cursor):
+    '''
+    Create the missing INDEXES on the existing tables and columns, the
+    columns added later by a model are indexed at its own registration.
+    '''
+    if backend.name() not in ('postgresql', 'sqlite'):
+        return
+    for name in OBSOLETE_INDEXES:
+        if _index_exists(cursor, name):
+            cursor.execute('DROP INDEX "%s"' % name)
+    TableHandler = backend.get('TableHandler')
+    for table, name, columns, condition in INDEXES:
+        if not TableHandler.table_exist(cursor, table) or _index_exists(cursor, name):
+            continue
+        if not set(columns).issubset(_table_columns(cursor, table)):
+            continue
+        query = 'CREATE INDEX "%s" ON "%s" (%s)' % (
+            name, table, ', '.join('"%s"' % c for c in columns))
+        if condition:
+            query += ' WHERE ' + condition
+        cursor.execute(query)
+
+
+# Tables moved to the archive with the condition selecting the rows of the
+# archived sessions and seances, children first
+ARCHIVED_TABLES = [
+    ('training_participation',
+        "seance_id IN (%(seances)s) OR subscription_line_id IN "
+        "(SELECT id FROM training_subscription_line WHERE session_id IN (%(sessions)s))"),
+    ('training_participation_stakeholder', "seance_id IN (%(seances)s)"),
+    ('training_seance_purchase_line', "seance_id IN (%(seances)s)"),
+    ('training_session_seance_rel', "session_id IN (%(sessions)s)"),
+    ('training_subscription_line', "session_id IN (%(sessions)s)"),
+    ('training_participation_stakeholder_request', "session_id IN (%(sessions)s)"),
+    ('training_waitlist', '"session" IN (%(sessions)s)'),
+    ('training_group', "session_id IN (%(sessions)s)"),
+    ('training_seance', "id IN (%(seances)s)"),
+    ('training_session', "id IN (%(sessions)s)"),
+    ]
+
+
+def _table_columns(cursor, table):
+    cursor.execute('SELECT * FROM "%s" WHERE 1 = 0' % table)
+    return [x[0] for x in cursor.description]
+
+
+def _column_types(cursor, table):
+    # The columns of table with their SQL type in their order
+    if backend.name() == 'postgresql':
+        cursor.execute("SELECT attname, format_type(atttypid, atttypmod) "
+                       "FROM pg_attribute "
+                       "WHERE attrelid = CAST(%s AS regclass) "
+                       "AND attnum > 0 AND NOT attisdropped "
+                       "ORDER BY attnum", ('"%s"' % table,))
+        return cursor.fetchall()
+    cursor.execute('PRAGMA table_info("%s")' % table)
+    return [(x[1], x[2]) for x in cursor.fetchall()]
+
+
+def _archive_columns(cursor, table):
+    # The columns shared by the table and its archive
+    archive_columns = set(_table_columns(cursor, table + '_archive'))
+    return [c for c in _table_columns(cursor, table) if c in archive_columns]
+
+
+def _view_exists(cursor, name):
+    if backend.name() == 'postgresql':
+        cursor.execute('SELECT 1 FROM pg_views WHERE viewname = %s', (name,))
+    else:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'view' AND name = %s", (name,))
+    return bool(cursor.fetchone())
+
+
+def _prepare_archives(cursor):
+    '''
+    Create or complete the archive tables of ARCHIVED_TABLES and their
+    <table>_all views, run at the registration of the models.
+    '''
+    if backend.name() not in ('postgresql', 'sqlite'):
+        return
+    TableHandler = backend.get('TableHandler')
+    for table, condition in ARCHIVED_TABLES:
+        if not TableHandler.table_exist(cursor, table):
+            continue
+        archive = table + '_archive'
+        if not TableHandler.table_exist(cursor, archive):
+            cursor.execute('CREATE TABLE "%s" AS SELECT * FROM "%s" WHERE 1 = 0'
+                % (archive, table))
+        else:
+            archived = set(_table_columns(cursor, archive))
+            for name, type_ in _column_types(cursor, table):
+                if name not in archived:
+                    cursor.execute('ALTER TABLE "%s" ADD COLUMN "%s" %s' % (archive, name, type_))
+        columns = _archive_columns(cursor, table)
+        view = table + '_all'
+        if _view_exists(cursor, view):
+            if _table_columns(cursor, view) == columns:
+                continue
+            cursor.execute('DROP VIEW "%s"' % view)
+        names = ', '.join('"%s"' % c for c in columns)
+        cursor.execute('CREATE VIEW "%s" AS '
+            'SELECT %s FROM "%s" UNION ALL SELECT %s FROM "%s"'
+            % (view, names, table, names, archive))
+
+
+def _external_references(cursor):
+    '''
+    Return the foreign keys of the tables outside of ARCHIVED_TABLES on the
+    archived tables as [(table, column, referenced table)].
+    '''
+    archived = set(x[0] for x in ARCHIVED_TABLES)
+    res = []
+    if backend.name() == 'postgresql':
+        cursor.execute("SELECT src.relname, att.attname, dst.relname "
+                       "FROM pg_constraint con "
+                       "JOIN pg_class src ON src.oid = con.conrelid "
+                       "JOIN pg_class dst ON dst.oid = con.confrelid "
+                       "JOIN pg_attribute att ON att.attrelid = con.conrelid "
+                       "AND att.attnum = con.conkey[1] "
+                       "WHERE con.contype = 'f'")
+        rows = cursor.fetchall()
+    else:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        rows = []
+        for table, in cursor.fetchall():
+            cursor.execute('PRAGMA foreign_key_list("%s")' % table)
+            rows.extend((table, x[3], x[2]) for x in cursor.fetchall())
+    for table, column, referenced in rows:
+        if referenced in archived and table not in archived and not table.endswith('_archive'):
+            res.append((table, column, referenced))
+    return res
+
+
+# Stored function fields recomputed through the queue with their table and
+# compute method
+RECOMPUTED_FIELDS = {
+    ('training.seance', 'confirmed_lecturer'): ('training_seance', '_confirmed_lecturer_compute'),
+    }
+
+# Fields to recompute by cursor as (model, field, res_id)
+_dirty = weakref.WeakKeyDictionary()
+
+
+def mark_dirty(cr, uid, model, field, ids):
+    '''
+    Mark the stored field of the records ids to be recomputed once when the
+    transaction of cr commits, whatever the number of writing calls.
+    '''
+    assert (model, field) in RECOMPUTED_FIELDS
+    real = _real_cursor(cr)
+    if real not in _dirty:
+        _dirty[real] = set()
+        _recompute_at_commit(real, uid)
+    _dirty[real].update((model, field, x) for x in ids if x)
+
+
+def _recompute_at_commit(cursor, uid):
+    # The cursor has no commit hook, its commit is wrapped until it runs,
+    # the records which fail to recompute are queued for the cron
+    commit = cursor.commit
+
+    def recompute_and_commit():
+        del cursor.commit
+        if _dirty.get(cursor):
+            queue = Pool(cursor.database_name).get('training.recompute.queue')
+            cursor.execute("SAVEPOINT training_recompute")
+            try:
+                queue.process_dirty(cursor, uid)
+            except Exception:
+                cursor.execute("ROLLBACK TO SAVEPOINT training_recompute")
+                logging.getLogger('trytond.modules.training').exception(
+                    'Recomputation left to the queue')
+                queue.enqueue(cursor, uid, _dirty.pop(cursor, set()))
+            else:
+                cursor.execute("RELEASE SAVEPOINT training_recompute")
+        _dirty.pop(cursor, None)
+        return commit()
+    cursor.commit = recompute_and_commit
+
+
+@contextmanager
+def query_budget(cr, budget, name=''):
+    '''
+    Run the block with a counting cursor and raise AssertionError if it
+    executes more than budget queries.
+    '''
+    cursor = CountingCursor(cr)
+    yield cursor
+    if cursor.queries > budget:
+        raise AssertionError('%s executed %d queries, the budget is %d'
+            % (name, cursor.queries, budget))
+
+
+def _model_name(obj):
+    return getattr(obj, '_name', None) or obj.__name__
+
+
+class Prefetch(object):
+    '''
+    Values of records loaded in batch for relation paths like
+    'seance_ids.contact_ids.state', one read by level.
+    '''
+
+    def __init__(self):
+        self.values = {}
+        self.relations = {}
+        self.depth = 0
+
+    def _relation(self, cr, uid, obj, model, name, context=None):
+        key = (model, name)
+        if key not in self.relations:
+            self.relations[key] = obj.fields_get(cr, uid, [name], context=context)[name].get('relation')
+        return self.relations[key]
+
+    def load(self, pool, cr, uid, model, ids, paths, context=None):
+        for path in paths:
+            current_model, current_ids = model, list(set(ids))
+            for name in path.split('.'):
+                obj = pool.get(current_model)
+                missing = [x for x in current_ids
+                           if name not in self.values.get((current_model, x), {})]
+                if missing:
+                    for values in obj.read(cr, uid, missing, [name], context=context):
+                        value = values[name]
+                        # Many2One are read as (id, name)
+                        if isinstance(value, tuple):
+                            value = value[0]
+                        self.values.setdefault((current_model, values['id']), {})[name] = value
+
+                relation = self._relation(cr, uid, obj, current_model, name, context=context)
+                if not relation:
+                    break
+                next_ids = set()
+                for x in current_ids:
+                    value = self.values[(current_model, x)][name]
+                    if isinstance(value, list):
+                        next_ids.update(value)
+                    elif value:
+                        next_ids.add(value)
+                current_model, current_ids = relation, list(next_ids)
+
+    def get(self, model, id_, name):
+        return self.values[(model, id_)][name]
+
+
+def prefetched(*paths):
+    '''
+    Decorate a method (self, cr, uid, ids, ...) to load the relation paths of
+    ids in batch, read with get_prefetched(cr).get(model, id, name).
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, cr, uid, ids, *args, **kwargs):
+            key = _real_cursor(cr)
+            cache = _prefetched.get(key)
+            if cache is None:
+                cache = _prefetched[key] = Prefetch()
+            cache.depth += 1
+            try:
+                cache.load(self.pool, cr, uid, _model_name(self), ids, paths,
+                           context=kwargs.get('context'))
+                return func(self, cr, uid, ids, *args, **kwargs)
+            finally:
+                cache.depth -= 1
+                if not cache.depth:
+                    del _prefetched[key]
+        return wrapper
+    return decorator
+
+
+def get_prefetched(cr):
+    return _prefetched[_real_cursor(cr)]
+
+
+def _invalidate_prefetched(cr):
+    # Every write of the module comes here, the reports of the transaction
+    # must then see its own changes
+    _written[_real_cursor(cr)] = True
+    cache = _prefetched.get(_real_cursor(cr))
+    if cache is not None:
+        cache.values.clear()
+
+
+# The cursors which wrote training rows, they do not read from the
+# reporting database
+_written = weakref.WeakKeyDictionary()
+
+# Lag of the reporting database by name as (time of the check, seconds)
+_report_lags = {}
+REPORT_LAG_TTL = 5
+
+# The connected reporting databases by name of each thread, their cursors
+# share the connection or take it from the pool of the backend
+_report_databases = threading.local()
+
+
+def _report_database(name):
+    databases = _report_databases.__dict__
+    if name not in databases:
+        databases[name] = backend.get('Database')(name).connect()
+    return databases[name]
+
+
+def _report_lag(cursor):
+    # The lag of a primary is 0, the one of a replica which has not replayed
+    # anything yet is unknown
+    if backend.name() != 'postgresql':
+        return 0
+    cursor.execute("SELECT CASE WHEN pg_is_in_recovery() "
+                   "THEN EXTRACT(EPOCH FROM (now() - pg_last_xact_replay_timestamp())) "
+                   "ELSE 0 END")
+    lag = cursor.fetchone()[0]
+    return float('inf') if lag is None else float(lag)
+
+
+def _report_cursor(cr):
+    '''
+    Return a cursor on the reporting database when it is fresh enough and
+    cr did not write training rows, None otherwise.
+    '''
+    name = CONFIG.get('training_report_db')
+    if not name or _real_cursor(cr) in _written:
+        return None
+    staleness = float(CONFIG.get('training_report_staleness', 30))
+    checked = _report_lags.get(name)
+    if checked and checked[0] > time.time() - REPORT_LAG_TTL and checked[1] > staleness:
+        return None
+
+    try:
+        cursor = _report_database(name).cursor()
+    except Exception:
+        _report_databases.__dict__.pop(name, None)
+        logging.getLogger('trytond.modules.training').warning(
+            'Reporting database %s unavailable', name, exc_info=True)
+        return None
+    if not checked or checked[0] <= time.time() - REPORT_LAG_TTL:
+        try:
+            checked = _report_lags[name] = (time.time(), _report_lag(cursor))
+        except Exception:
+            cursor.close()
+            return None
+    if checked[1] > staleness:
+        cursor.close()
+        return None
+    return cursor
+
+
+def _report_fetchall(cr, query, args):
+    '''
+    Execute the read only query on the reporting database when it can be
+    used and on cr otherwise and return its rows.
+    '''
+    cursor = _report_cursor(cr)
+    if cursor is not None:
+        try:
+            cursor.execute(query, args)
+            return cursor.fetchall()
+        except Exception:
+            logging.getLogger('trytond.modules.training').warning(
+                'Reporting query failed, falling back to the primary', exc_info=True)
+        finally:
+            cursor.close()
+    cr.execute(query, args)
+    return cr.fetchall()
+
+
+# Columns of the participation export as (name, expression, arrow type)
+EXPORT_COLUMNS = [
+    ('participation_id', 'tp.id', 'int64'),
+    ('present', 'tp.present', 'bool'),
+    ('seance_id', 's.id', 'int64'),
+    ('seance_name', 's.name', 'string'),
+    ('seance_date', 's.date', 'timestamp'),
+    ('seance_duration', 's.duration', 'float64'),
+    ('seance_state', 's.state', 'string'),
+    ('session_id', 'ss.id', 'int64'),
+    ('session_name', 'ss.name', 'string'),
+    ('session_state', 'ss.state', 'string'),
+    ('subscription_line_id', 'tsl.id', 'int64'),
+    ('subscription_line_state', 'tsl.state', 'string'),
+    ('contact_id', 'c.id', 'int64'),
+    ('contact_first_name', 'c.first_name', 'string'),
+    ('contact_name', 'c.name', 'string'),
+    ('partner_name', 'p.name', 'string'),
+    ]
+
+
+# The databases of the parent process in the certificate workers, kept so
+# their inherited connections are never closed from the worker
+_inherited_databases = []
+
+
+def _init_certificate_worker():
+    '''
+    Drop the connections inherited from the parent process so the worker
+    opens its own ones instead of sharing their sockets.
+    '''
+    databases = getattr(backend.get('Database'), '_databases', {})
+    _inherited_databases.append((dict(databases), dict(_report_databases.__dict__)))
+    databases.clear()
+    _report_databases.__dict__.clear()
+
+
+def _render_certificates(args):
+    '''
+    Render in a worker process the certificates of the participations ids
+    with its own transaction and return them as [(id, pdf)].
+    '''
+    database_name, uid, report_name, ids, context = args
+    with Transaction().start(database_name, uid, context=context):
+        cursor = Transaction().cursor
+        report = netsvc.LocalService(report_name)
+        return [(x, report.create(cursor, uid, [x], {}, context=context)[0]) for x in ids]
+
+
+def _to_datetime(value):
+    # SQLite returns the datetime columns of raw queries as strings
+    if isinstance(value, datetime) or value is None:
+        return value
+    return datetime.strptime(value[:19], '%Y-%m-%d %H:%M:%S')
+
+
+def _ical_escape(value):
+    return (value or '').replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+
+def _ical_datetime(value):
+    return _to_datetime(value).strftime('%Y%m%dT%H%M%S')
+
+
+def _holiday_periods(cr, date_from, date_to):
+    cr.execute("SELECT date_start, date_stop "
+               "FROM training_holiday_period "
+               "WHERE date_stop >= %s AND date_start <= %s "
+               "ORDER BY date_start",
+               (_to_datetime(date_from).date(), _to_datetime(date_to).date()))
+    res = []
+    for start, stop in cr.fetchall():
+        if not isinstance(start, date):
+            start = datetime.strptime(start[:10], '%Y-%m-%d').date()
+            stop = datetime.strptime(stop[:10], '%Y-%m-%d').date()
+        res.append((start, stop))
+    return res
+
+
+def _next_working_day(value, periods):
+    '''
+    Return value moved to the first day after the holiday periods it falls
+    in, keeping its time.
+    '''
+    moved = True
+    while moved:
+        moved = False
+        for start, stop in periods:
+            if start <= value.date() <= stop:
+                value += timedelta(days=(stop - value.date()).days + 1)
+                moved = True
+    return value
+
+
+def _bulk_insert(cr, table, columns, rows, returning=True):
+    '''
+    Insert rows in table with one statement when the database supports
+    RETURNING and return the new ids in the order of rows.
+    '''
+    if not rows:
+        return []
+    names = ', '.join('"%s"' % c for c in columns)
+    placeholders = '(' + ', '.join(['%s'] * len(columns)) + ')'
+    if not returning or cr.has_returning():
+        query = 'INSERT INTO "%s" (%s) VALUES %s' % (table, names,
+            ', '.join([placeholders] * len(rows)))
+        if returning:
+            query += ' RETURNING id'
+        cr.execute(query, [v for row in rows for v in row])
+        return returning and [x[0] for x in cr.fetchall()] or []
+
+    ids = []
+    for row in rows:
+        cr.execute('INSERT INTO "%s" (%s) VALUES %s' % (table, names, placeholders), row)
+        ids.append(cr.lastid())
+    return ids
+
+
+def _bulk_update(cr, table, column, values, uid):
+    '''
+    Set column of table to the values of the dictionary id: value with one
+    statement.
+    '''
+    if not values:
+        return
+    ids = list(values)
+    cr.execute('UPDATE "%s" SET "%s" = CASE id %s END, write_uid = %%s, write_date = %%s '
+               'WHERE id IN (%s)' % (table, column, ' '.join(['WHEN %s THEN %s'] * len(ids)),
+                                     ','.join(['%s'] * len(ids))),
+               [v for x in ids for v in (x, values[x])] + [uid, datetime.now()] + ids)
+
+
+def _update_seance_chains(cr, seance_ids=None):
+    '''
+    Set the chain and the position by date in the chain of the seances
+    seance_ids (all if None) and of their children.
+    '''
+    if seance_ids is None:
+        cr.execute("UPDATE training_seance SET chain_id = COALESCE(master_id, id)")
+        condition, args = "", []
+    else:
+        if not seance_ids:
+            return
+        seance_ids = list(seance_ids)
+        in_ids = ",".join(['%s'] * len(seance_ids))
+        # The chains left by the seances are renumbered too
+        cr.execute("SELECT DISTINCT chain_id FROM training_seance "
+                   "WHERE (id IN (" + in_ids + ") OR master_id IN (" + in_ids + ")) "
+                   "AND chain_id IS NOT NULL", seance_ids * 2)
+        args = set(x[0] for x in cr.fetchall())
+        cr.execute("UPDATE training_seance SET chain_id = COALESCE(master_id, id) "
+                   "WHERE id IN (" + in_ids + ") OR master_id IN (" + in_ids + ")",
+                   seance_ids * 2)
+        cr.execute("SELECT DISTINCT chain_id FROM training_seance "
+                   "WHERE id IN (" + in_ids + ") OR master_id IN (" + in_ids + ")",
+                   seance_ids * 2)
+        args = list(args.union(x[0] for x in cr.fetchall()))
+        condition = "WHERE chain_id IN (" + ",".join(['%s'] * len(args)) + ")"
+    cr.execute("UPDATE training_seance SET chain_position = ("
+               "SELECT COUNT(*) FROM training_seance o "
+               "WHERE o.chain_id = training_seance.chain_id "
+               "AND (o.date < training_seance.date "
+               "OR (o.date = training_seance.date AND o.id < training_seance.id))) " + condition, args)
+
+
+def _signal_sessions(cr, uid, session_ids, signal):
+    '''
+    Send signal to the workflow of the sessions session_ids once by session,
+    or defer it to the end of the chunk when the scheduler runs.
+    '''
+    deferred = _deferred_session_signals.get(_real_cursor(cr))
+    if deferred is not None:
+        pending = deferred.setdefault(signal, [])
+        pending.extend(x for x in session_ids if x not in pending)
+        return
+    workflow = netsvc.LocalService('workflow')
+    done = set()
+    for session_id in session_ids:
+        if session_id not in done:
+            done.add(session_id)
+            workflow.trg_validate(uid, 'training.session', session_id, signal, cr)
+
+
+@contextmanager
+def _defer_session_signals(cr, uid):
+    '''
+    Collect the session signals sent in the block and send each of them once
+    at its end in its own savepoint.
+    '''
+    key = _real_cursor(cr)
+    deferred = _deferred_session_signals[key] = {}
+    try:
+        yield deferred
+    finally:
+        del _deferred_session_signals[key]
+    workflow = netsvc.LocalService('workflow')
+    for signal in ('signal_inprogress', 'signal_close'):
+        for session_id in deferred.get(signal, []):
+            cr.execute("SAVEPOINT training_session_signal")
+            try:
+                workflow.trg_validate(uid, 'training.session', session_id, signal, cr)
+            except Exception:
+                cr.execute("ROLLBACK TO SAVEPOINT training_session_signal")
+                logging.getLogger('trytond.modules.training').exception(
+                    'Session %s could not receive %s', session_id, signal)
+                continue
+            cr.execute("RELEASE SAVEPOINT training_session_signal")
+
+
+def _append_events(cr, uid, model, event, rows):
+    '''
+    Append to the training_event outbox one event by (res_id, payload) of
+    rows with one statement in the transaction of cr.
+    '''
+    if not rows:
+        return
+    now = datetime.now()
+    _bulk_insert(cr, 'training_event', ['model', 'res_id', 'event', 'payload', 'create_uid', 'create_date'],
+                 [[model, res_id, event, json.dumps(payload, separators=(',', ':')), uid, now]
+                  for res_id, payload in rows], returning=False)
+
+
+def _read_states(cr, table, ids):
+    if not ids:
+        return {}
+    cr.execute('SELECT id, state FROM "%s" WHERE id IN (%s)' % (table, ','.join(['%s'] * len(ids))), ids)
+    return dict(cr.fetchall())
+
+
+def _append_state_events(cr, uid, model, old_states, state):
+    # Only the records which really change of state make an event
+    _append_events(cr, uid, model, 'state',
+                   [(res_id, {'from' : old, 'to' : state})
+                    for res_id, old in sorted(old_states.items()) if old != state])
+
+
+def _session_seance_pairs(cr, column, ids):
+    if not ids:
+        return set()
+    cr.execute("SELECT session_id, seance_id FROM training_session_seance_rel "
+               "WHERE " + column + " IN (" + ",".join(['%s'] * len(ids)) + ")", ids)
+    return set(cr.fetchall())
+
+
+def _append_link_events(cr, uid, before, after):
+    # The calendars of the sessions follow the seances added and removed
+    _append_events(cr, uid, 'training.session', 'seance_added',
+                   [(session_id, {'seance_id' : seance_id}) for session_id, seance_id in sorted(after - before)])
+    _append_events(cr, uid, 'training.session', 'seance_removed',
+                   [(session_id, {'seance_id' : seance_id}) for session_id, seance_id in sorted(before - after)])
+
+
+def _select_rows(cr, query, args):
+    '''
+    Return the column names and the rows of query as dictionaries.
+    '''
+    cr.execute(query, args)
+    columns = [x[0] for x in cr.description]
+    return columns, [dict(izip(columns, row)) for row in cr.fetchall()]
+
+
+def _overlaps(intervals):
+    '''
+    Yield the pairs of keys of the overlapping (start, end, key) intervals
+    with a sweep in start order.
+    '''
+    active = []
+    for start, end, key in sorted(intervals):
+        while active and active[0][0] <= start:
+            heapq.heappop(active)
+        for other_end, other in active:
+            if other != key:
+                yield other, key
+        heapq.heappush(active, (end, key))
+
+
 class TrainingGroup(ModelView, ModelSQL):
     'Group'
     __name__ = 'training.group'
@@ -52,6 +969,14 @@ class TrainingGroup(ModelView, ModelSQL):
 class TrainingSession(ModelView, ModelSQL):
     'Session'
     __name__ = 'training.session'
+    _available_seats_cache = Cache('training.session.available_seats',
+        context=False)
+
+    @classmethod
+    def __register__(cls, module_name):
+        super(TrainingSession, cls).__register__(module_name)
+        _create_indexes(Transaction().cursor)
+        _prepare_archives(Transaction().cursor)
 
     def _has_shared_seances_compute(self, cr, uid, ids, fieldnames, args, context=None):
         res = dict.fromkeys(ids, False)
@@ -81,52 +1006,64 @@ class TrainingSession(ModelView, ModelSQL):
 
         return list(result)
 
+    @instrumented
     def _participant_count(self, cr, uid, ids, fieldnames, args, context=None):
         res = dict.fromkeys(ids, 0)
 
-        cr.execute("""SELECT ss.session_id, COUNT(DISTINCT(tsl.contact_id))
-                        FROM training_participation tp, training_subscription_line tsl, training_session_seance_rel ss
-                       WHERE tp.subscription_line_id = tsl.id
-                         AND ss.seance_id = tp.seance_id
-                         AND ss.session_id in (%s)
-                         AND tsl.state in ('confirmed', 'done')
-                    GROUP BY ss.session_id
-                   """ % (','.join(['%s'] * len(ids)),),
-                   ids
-                  )
-        for seance_id, count in cr.fetchall():
-            res[seance_id] = int(count)
+        if not ids:
+            return res
+
+        for session_id, count in _report_fetchall(cr, _counting_query('training.session.participant_count', ids), ids):
+            res[session_id] = int(count)
         return res
 
     # training.session
     def _confirmed_subscriptions_count(self, cr, uid, ids, fieldnames, args, context=None):
         res = dict.fromkeys(ids, 0)
-        sl_proxy = self.pool.get('training.subscription.line')
-        for session_id in ids:
-            res[session_id] = int(sl_proxy.search_count(cr, uid, [('session_id', '=', session_id),('state', 'in', ['confirmed', 'done'])], context=context))
+        if not ids:
+            return res
+
+        cr.execute(_counting_query('training.session.confirmed_subscriptions', ids), ids)
+        for session_id, count in cr.fetchall():
+            res[session_id] = int(count)
 
         return res
 
     # training.session
     def _available_seats_compute(self, cr, uid, ids, fieldnames, args, context=None):
         res = dict.fromkeys(ids, 0)
+        if not ids:
+            return res
 
-        for session in self.browse(cr, uid, ids, context=context):
-            if session.manual:
-                value_max = session.participant_count_manual
+        counts = self._participant_count(cr, uid, ids, fieldnames, args, context=context)
+        for values in self.read(cr, uid, ids, ['max_limit', 'manual', 'participant_count_manual'], context=context):
+            if values['manual']:
+                value_max = values['participant_count_manual']
             else:
-                value_max = session.participant_count
-            res[session.id] = int(session.max_limit) - int(value_max)
+                value_max = counts[values['id']]
+            res[values['id']] = int(values['max_limit']) - int(value_max or 0)
 
         return res
 
+    # training.session
+    @instrumented
+    def get_available_seats(self, cr, uid, ids, context=None):
+        '''
+        Return the available seats of many sessions, cached until a
+        participation or state change.
+        '''
+        return _cached_seats(self._available_seats_cache, ids,
+            lambda missing: self._available_seats_compute(cr, uid, missing, None, None, context=context))
+
     # training.session
     def _draft_subscriptions_count(self, cr, uid, ids, fieldnames, args, context=None):
         res = dict.fromkeys(ids, 0)
+        if not ids:
+            return res
 
-        proxy = self.pool.get("training.subscription.line")
-        for session_id in ids:
-            res[session_id] = int(proxy.search_count(cr, uid, [('session_id', '=', session_id),('state', '=', 'draft')], context=context))
+        cr.execute(_counting_query('training.session.draft_subscriptions', ids), ids)
+        for session_id, count in cr.fetchall():
+            res[session_id] = int(count)
 
         return res
 
@@ -552,66 +1489,535 @@ class TrainingSession(ModelView, ModelSQL):
 
 
     # training.session
-    def _create_participation(self, cr, uid, ids, subscription_line, context=None):
+    def _lock(self, cr, ids):
+        # The sessions are locked before their seances so every reservation
+        # takes the locks in the same order
+        if ids and backend.name() == 'postgresql':
+            cr.execute("SELECT id FROM training_session "
+                       "WHERE id IN (" + ",".join(['%s'] * len(ids)) + ") "
+                       "ORDER BY id FOR UPDATE", sorted(ids))
+
+    # training.session
+    def _free_seats(self, cr, uid, ids, line_ids=None, context=None):
+        # The seats of a session are held by its subscription lines which are
+        # not cancelled and have participations, except line_ids which are
+        # being reserved, the value is None for the sessions without maximum
+        # threshold or in manual mode
+        res = {}
+        if not ids:
+            return res
+        line_ids = list(line_ids or [])
+
+        cr.execute("SELECT s.id, s.max_limit, s.manual, COUNT(DISTINCT(tp.subscription_line_id)) "
+                   "FROM training_session s "
+                   "LEFT JOIN training_subscription_line tsl ON tsl.session_id = s.id "
+                   "AND tsl.state != 'cancelled' "
+                   + (line_ids and "AND tsl.id NOT IN (" + ",".join(['%s'] * len(line_ids)) + ") " or "") +
+                   "LEFT JOIN training_participation tp ON tp.subscription_line_id = tsl.id "
+                   "WHERE s.id IN (" + ",".join(['%s'] * len(ids)) + ") "
+                   "GROUP BY s.id, s.max_limit, s.manual", line_ids + list(ids))
+
+        for session_id, max_limit, manual, count in cr.fetchall():
+            if manual or not max_limit or max_limit <= 0:
+                res[session_id] = None
+            else:
+                res[session_id] = max(max_limit - int(count), 0)
+        return res
+
+    # training.session
+    @instrumented
+    def _create_participation(self, cr, uid, ids, subscription_line, waitlist=True, context=None):
         proxy = self.pool.get('training.participation')
         proxy_seance = self.pool.get('training.seance')
 
+        seances = []
+        self._lock(cr, [subscription_line.session_id.id])
         if subscription_line.session_id.group_ids:
-            for group in subscription_line.session_id.group_ids:
-                if len(group.seance_ids) > 0:
-                    for seance in group.seance_ids:
-                        participation_id = proxy_seance._create_participation(cr, uid, seance, subscription_line, context=context)
-                        if seance.state == 'confirmed':
-                            proxy.create_procurements(cr, uid, [participation_id], delayed=True, context=context)
-                    break
+            groups = [group for group in subscription_line.session_id.group_ids if len(group.seance_ids) > 0]
+            if groups:
+                # The group is chosen under the locks of the reservation, when
+                # every group is full the reservation on the first one reports it
+                proxy_seance._lock(cr, [seance.id for group in groups for seance in group.seance_ids])
+                allocation = self.allocate_groups(cr, uid, subscription_line.session_id.id, [subscription_line], context=context)
+                group_id = allocation.get(subscription_line.id, groups[0].id)
+                seances = [group for group in groups if group.id == group_id][0].seance_ids
         else:
-            for seance in subscription_line.session_id.seance_ids:
-                participation_id = proxy_seance._create_participation(cr, uid, seance, subscription_line, context=context)
+            seances = subscription_line.session_id.seance_ids
+
+        result = proxy_seance.reserve_seats(cr, uid, [seance.id for seance in seances], subscription_line, context=context)
+        if result['status'] == 'reserved':
+            for seance, participation_id in izip(seances, result['participation_ids']):
                 if seance.state == 'confirmed':
                     proxy.create_procurements(cr, uid, [participation_id], delayed=True, context=context)
+        elif waitlist:
+            result['waitlist_position'] = self.pool.get('training.waitlist').add_waiter(cr, uid, subscription_line, context=context)
+
+        return result
+
+    # training.session
+    def _group_seances(self, cr, uid, session_id, context=None):
+        cr.execute("SELECT s.group_id, s.id "
+                   "FROM training_seance s, training_group g "
+                   "WHERE g.id = s.group_id "
+                   "AND g.session_id = %s "
+                   "AND s.state != 'cancelled' "
+                   "ORDER BY g.id", (session_id,))
+        res = {}
+        for group_id, seance_id in cr.fetchall():
+            res.setdefault(group_id, []).append(seance_id)
+        return res
+
+    # training.session
+    @instrumented
+    def allocate_groups(self, cr, uid, session_id, subscription_lines, mode='least_loaded', context=None):
+        '''
+        Spread subscription_lines over the groups of session_id, 'least_loaded'
+        or 'round_robin', and return {line id: group id}.
+        '''
+        assert mode in ('least_loaded', 'round_robin')
+        group_seances = self._group_seances(cr, uid, session_id, context=context)
+        if not group_seances:
+            return {}
+
+        seance_ids = [x for v in group_seances.values() for x in v]
+        free = self.pool.get('training.seance')._free_seats(cr, uid, seance_ids, context=context)
+
+        cr.execute("SELECT s.group_id, COUNT(DISTINCT(tp.subscription_line_id)) "
+                   "FROM training_participation tp, training_subscription_line tsl, training_seance s "
+                   "WHERE tp.subscription_line_id = tsl.id "
+                   "AND tp.seance_id = s.id "
+                   "AND tsl.state != 'cancelled' "
+                   "AND s.id IN (" + ",".join(['%s'] * len(seance_ids)) + ") "
+                   "GROUP BY s.group_id", seance_ids)
+        loads = dict.fromkeys(group_seances, 0)
+        loads.update((group_id, int(count)) for group_id, count in cr.fetchall())
+
+        # The capacity of a group is the smallest free capacity of its
+        # seances, None when it is unlimited
+        capacities = {}
+        for group_id, ids in group_seances.items():
+            limited = [free[x] for x in ids if free.get(x) is not None]
+            capacities[group_id] = min(limited) if limited else None
+
+        groups = [g for g in sorted(group_seances) if capacities[g] != 0]
+        if mode == 'least_loaded':
+            queue = [(loads[g], g) for g in groups]
+            heapq.heapify(queue)
+        else:
+            queue = deque(groups)
+
+        res = {}
+        for line in subscription_lines:
+            if not queue:
+                break
+            if mode == 'least_loaded':
+                load, group_id = heapq.heappop(queue)
+            else:
+                group_id = queue.popleft()
+
+            res[line.id] = group_id
+            if capacities[group_id] is not None:
+                capacities[group_id] -= 1
+            if capacities[group_id] != 0:
+                if mode == 'least_loaded':
+                    heapq.heappush(queue, (load + 1, group_id))
+                else:
+                    queue.append(group_id)
+
+        return res
+
+    # training.session
+    @instrumented
+    def create_group_participations(self, cr, uid, session_id, subscription_lines, mode='least_loaded', context=None):
+        '''
+        Allocate subscription_lines to the groups of session_id under lock and
+        create their participations, return the allocation.
+        '''
+        proxy = self.pool.get('training.participation')
+        proxy_seance = self.pool.get('training.seance')
+
+        self._lock(cr, [session_id])
+        group_seances = self._group_seances(cr, uid, session_id, context=context)
+        proxy_seance._lock(cr, [x for v in group_seances.values() for x in v])
+
+        # The lines beyond the free seats of the session are left out like
+        # the ones which do not fit in a group
+        free = self._free_seats(cr, uid, [session_id], [line.id for line in subscription_lines],
+                                context=context).get(session_id)
+        if free is not None:
+            subscription_lines = subscription_lines[:free]
+
+        allocation = self.allocate_groups(cr, uid, session_id, subscription_lines, mode=mode, context=context)
+        confirmed = []
+        for line in subscription_lines:
+            group_id = allocation.get(line.id)
+            if not group_id:
+                continue
+            for seance in proxy_seance.browse(cr, uid, group_seances[group_id], context=context):
+                participation_id = proxy_seance._create_participation(cr, uid, seance, line, context=context)
+                if seance.state == 'confirmed':
+                    confirmed.append(participation_id)
+
+        # Like the single reservations, the confirmed seances get their
+        # procurements, in one call
+        if confirmed:
+            proxy.create_procurements(cr, uid, confirmed, delayed=True, context=context)
+
+        return allocation
+
+    # training.session
+    @instrumented
+    def reconcile_participations(self, cr, uid, session_ids, context=None):
+        '''
+        Create the missing and remove the stale participations of the lines of
+        session_ids, return the created, removed, unallocated and overbooked ids.
+        '''
+        res = {'created' : [], 'removed' : [], 'unallocated' : [], 'overbooked' : []}
+        if not session_ids:
+            return res
+        proxy = self.pool.get('training.participation')
+        proxy_line = self.pool.get('training.subscription.line')
+        in_sessions = ",".join(['%s'] * len(session_ids))
+
+        cr.execute("SELECT rel.seance_id FROM training_session_seance_rel rel "
+                   "WHERE rel.session_id IN (" + in_sessions + ")", session_ids)
+        self.pool.get('training.seance')._lock(cr, sorted(set(x[0] for x in cr.fetchall())))
+
+        cr.execute("SELECT DISTINCT g.session_id "
+                   "FROM training_group g, training_seance s "
+                   "WHERE s.group_id = g.id "
+                   "AND s.state != 'cancelled' "
+                   "AND g.session_id IN (" + in_sessions + ")", session_ids)
+        grouped = set(x[0] for x in cr.fetchall())
+
+        cr.execute("SELECT id, session_id FROM training_subscription_line "
+                   "WHERE state IN ('draft', 'confirmed', 'done') "
+                   "AND session_id IN (" + in_sessions + ") "
+                   "ORDER BY id", session_ids)
+        lines = cr.fetchall()
+        if not lines:
+            return res
+
+        # The group of a line is the one of its participations
+        cr.execute("SELECT tp.subscription_line_id, MIN(s.group_id) "
+                   "FROM training_participation tp, training_subscription_line tsl, "
+                   "training_seance s, training_group g "
+                   "WHERE tsl.id = tp.subscription_line_id "
+                   "AND s.id = tp.seance_id "
+                   "AND g.id = s.group_id "
+                   "AND g.session_id = tsl.session_id "
+                   "AND tsl.state IN ('draft', 'confirmed', 'done') "
+                   "AND tsl.session_id IN (" + in_sessions + ") "
+                   "GROUP BY tp.subscription_line_id", session_ids)
+        line_groups = dict(cr.fetchall())
+
+        unassigned = {}
+        for line_id, session_id in lines:
+            if session_id in grouped and line_id not in line_groups:
+                unassigned.setdefault(session_id, []).append(line_id)
+        for session_id, line_ids in unassigned.items():
+            allocation = self.allocate_groups(cr, uid, session_id,
+                                              proxy_line.browse(cr, uid, line_ids, context=context),
+                                              context=context)
+            for line_id in line_ids:
+                if line_id in allocation:
+                    line_groups[line_id] = allocation[line_id]
+                else:
+                    res['unallocated'].append(line_id)
+
+        # The lines which did not fit in a group expect no seance
+        unallocated = set(res['unallocated'])
+        cr.execute("DROP TABLE IF EXISTS training_reconcile_group")
+        cr.execute("CREATE TEMPORARY TABLE training_reconcile_group "
+                   "(subscription_line_id INTEGER, session_id INTEGER, group_id INTEGER, grouped BOOLEAN)")
+        _bulk_insert(cr, 'training_reconcile_group',
+                     ['subscription_line_id', 'session_id', 'group_id', 'grouped'],
+                     [[line_id, session_id, line_groups.get(line_id), session_id in grouped]
+                      for line_id, session_id in lines if line_id not in unallocated],
+                     returning=False)
+
+        expected = ("FROM training_reconcile_group rg, training_session_seance_rel rel, training_seance s "
+                    "WHERE rel.session_id = rg.session_id "
+                    "AND s.id = rel.seance_id "
+                    "AND s.state != 'cancelled' "
+                    "AND (NOT rg.grouped OR s.group_id = rg.group_id) ")
+
+        cr.execute("SELECT rg.subscription_line_id, s.id, s.state " + expected +
+                   "AND NOT EXISTS (SELECT 1 FROM training_participation tp "
+                   "WHERE tp.seance_id = s.id "
+                   "AND tp.subscription_line_id = rg.subscription_line_id) "
+                   "ORDER BY rg.subscription_line_id, s.id")
+        missing = cr.fetchall()
+
+        cr.execute("SELECT tp.id "
+                   "FROM training_participation tp, training_subscription_line tsl "
+                   "WHERE tsl.id = tp.subscription_line_id "
+                   "AND tsl.state IN ('draft', 'confirmed', 'done') "
+                   "AND tsl.session_id IN (" + in_sessions + ") "
+                   "AND tp.subscription_line_id IN (SELECT subscription_line_id FROM training_reconcile_group) "
+                   "AND NOT EXISTS (SELECT 1 " + expected +
+                   "AND rg.subscription_line_id = tp.subscription_line_id "
+                   "AND s.id = tp.seance_id) "
+                   "ORDER BY tp.id", session_ids)
+        res['removed'] = [x[0] for x in cr.fetchall()]
+        cr.execute("DROP TABLE training_reconcile_group")
+
+        if res['removed']:
+            ctx = dict(context or {}, no_waitlist_promotion=True)
+            proxy.unlink(cr, uid, res['removed'], context=ctx)
+
+        # The seats are counted once the stale participations are removed,
+        # the seances stay locked until the end of the transaction
+        free_seats = self.pool.get('training.seance')._free_seats(
+            cr, uid, sorted(set(x[1] for x in missing)), context=context)
+        fitting = []
+        overbooked = set()
+        for line_id, seance_id, state in missing:
+            free = free_seats.get(seance_id)
+            if free is None:
+                fitting.append((line_id, seance_id, state))
+            elif free > 0:
+                free_seats[seance_id] = free - 1
+                fitting.append((line_id, seance_id, state))
+            else:
+                overbooked.add(seance_id)
+        res['overbooked'] = sorted(overbooked)
+        missing = fitting
+
+        now = datetime.now()
+        res['created'] = _bulk_insert(cr, 'training_participation',
+                                      ['subscription_line_id', 'seance_id', 'present', 'create_uid', 'create_date'],
+                                      [[line_id, seance_id, False, uid, now] for line_id, seance_id, state in missing])
+        _append_events(cr, uid, 'training.participation', 'create',
+                       [(participation_id, {'seance_id' : seance_id, 'subscription_line_id' : line_id})
+                        for participation_id, (line_id, seance_id, state) in izip(res['created'], missing)])
+        _invalidate_available_seats()
+        _invalidate_prefetched(cr)
+
+        confirmed = [participation_id for participation_id, (line_id, seance_id, state) in izip(res['created'], missing)
+                     if state == 'confirmed']
+        if confirmed:
+            proxy.create_procurements(cr, uid, confirmed, delayed=True, context=context)
+
+        return res
+
+    # training.session
+    def archive_sessions(self, cr, uid, days=None, batch_size=None, max_batches=None, context=None):
+        '''
+        Move the closed and cancelled sessions older than days and their rows to
+        the archive tables by batches, return the number of archived sessions.
+        '''
+        if days is None:
+            days = int(CONFIG.get('training_archive_days', 730))
+        if batch_size is None:
+            batch_size = int(CONFIG.get('training_archive_batch_size', 200))
+        TableHandler = backend.get('TableHandler')
+        threshold = datetime.now() - timedelta(days=days)
+
+        tables = [(table, condition, _archive_columns(cr, table))
+                  for table, condition in ARCHIVED_TABLES
+                  if TableHandler.table_exist(cr, table + '_archive')]
+        references = _external_references(cr)
+
+        def where(condition, session_ids, seance_ids):
+            return condition % {
+                'sessions' : ','.join(str(int(x)) for x in session_ids),
+                'seances' : ','.join(str(int(x)) for x in seance_ids) or 'NULL',
+            }
+
+        def archived_seances(session_ids):
+            # The seances shared with a session kept alive stay alive
+            sessions = ','.join(str(int(x)) for x in session_ids)
+            cr.execute("SELECT DISTINCT rel.seance_id "
+                       "FROM training_session_seance_rel rel "
+                       "WHERE rel.session_id IN (" + sessions + ") "
+                       "AND NOT EXISTS (SELECT 1 FROM training_session_seance_rel other "
+                       "WHERE other.seance_id = rel.seance_id "
+                       "AND other.session_id NOT IN (" + sessions + "))")
+            return [x[0] for x in cr.fetchall()]
+
+        def referenced(session_ids, seance_ids):
+            conditions = dict(ARCHIVED_TABLES)
+            for table, column, target in references:
+                cr.execute('SELECT 1 FROM "%s" WHERE "%s" IN (SELECT id FROM "%s" WHERE %s) LIMIT 1'
+                           % (table, column, target, where(conditions[target], session_ids, seance_ids)))
+                if cr.fetchone():
+                    return True
+            return False
+
+        archived = 0
+        batches = 0
+        kept = []
+        while max_batches is None or batches < max_batches:
+            cr.execute("SELECT id FROM training_session "
+                       "WHERE state IN ('closed', 'cancelled') "
+                       "AND date < %s "
+                       + (kept and "AND id NOT IN (" + ",".join(['%s'] * len(kept)) + ") " or "") +
+                       "ORDER BY date, id LIMIT %s", [threshold] + kept + [batch_size])
+            session_ids = [x[0] for x in cr.fetchall()]
+            if not session_ids:
+                break
+
+            seance_ids = archived_seances(session_ids)
+            if references and referenced(session_ids, seance_ids):
+                # Only the sessions referenced from outside are kept
+                for session_id in list(session_ids):
+                    if referenced([session_id], archived_seances([session_id])):
+                        session_ids.remove(session_id)
+                        kept.append(session_id)
+                if not session_ids:
+                    continue
+                seance_ids = archived_seances(session_ids)
+
+            # The seances kept alive must not follow the archived rows,
+            # training_seance.original_session_id cascades on delete
+            sessions = ','.join(str(int(x)) for x in session_ids)
+            seances = ','.join(str(int(x)) for x in seance_ids) or 'NULL'
+            cr.execute("UPDATE training_seance SET original_session_id = ("
+                       "SELECT MIN(rel.session_id) FROM training_session_seance_rel rel "
+                       "WHERE rel.seance_id = training_seance.id "
+                       "AND rel.session_id NOT IN (" + sessions + ")) "
+                       "WHERE original_session_id IN (" + sessions + ") "
+                       "AND id NOT IN (" + seances + ")")
+            cr.execute("UPDATE training_seance SET group_id = NULL "
+                       "WHERE group_id IN (SELECT id FROM training_group WHERE session_id IN (" + sessions + ")) "
+                       "AND id NOT IN (" + seances + ")")
+            cr.execute("SELECT id FROM training_seance "
+                       "WHERE (master_id IN (" + seances + ") OR chain_id IN (" + seances + ")) "
+                       "AND id NOT IN (" + seances + ")")
+            orphan_ids = [x[0] for x in cr.fetchall()]
+            if orphan_ids:
+                cr.execute("UPDATE training_seance SET master_id = NULL "
+                           "WHERE master_id IN (" + seances + ") "
+                           "AND id NOT IN (" + seances + ")")
+                cr.execute("UPDATE training_seance SET chain_id = NULL "
+                           "WHERE chain_id IN (" + seances + ") "
+                           "AND id NOT IN (" + seances + ")")
+
+            cr.execute("SELECT id, seance_id, subscription_line_id FROM training_participation "
+                       "WHERE " + where(dict(ARCHIVED_TABLES)['training_participation'], session_ids, seance_ids) +
+                       " ORDER BY id")
+            participations = [(x, {'seance_id' : y, 'subscription_line_id' : z}) for x, y, z in cr.fetchall()]
+            _append_events(cr, uid, 'training.session', 'archive', [(x, {}) for x in sorted(session_ids)])
+            _append_events(cr, uid, 'training.seance', 'archive', [(x, {}) for x in sorted(seance_ids)])
+            _append_events(cr, uid, 'training.participation', 'archive', participations)
+
+            for table, condition, columns in tables:
+                names = ', '.join('"%s"' % c for c in columns)
+                condition = where(condition, session_ids, seance_ids)
+                cr.execute('INSERT INTO "%s_archive" (%s) SELECT %s FROM "%s" WHERE %s'
+                           % (table, names, names, table, condition))
+                cr.execute('DELETE FROM "%s" WHERE %s' % (table, condition))
+            _update_seance_chains(cr, orphan_ids)
+            # Each batch is committed on its own so the locks stay short
+            cr.commit()
+
+            archived += len(session_ids)
+            batches += 1
+
+        if archived:
+            _invalidate_available_seats()
+            _invalidate_prefetched(cr)
+        return archived
+
+    # training.session
+    def explain_counting_queries(self, cr, uid, session_ids, seance_ids, context=None):
+        '''
+        Return the execution plan of each of the COUNTING_QUERIES for the
+        given records to check they use the INDEXES.
+        '''
+        if backend.name() == 'sqlite':
+            explain = 'EXPLAIN QUERY PLAN '
+        else:
+            explain = 'EXPLAIN '
+
+        res = {}
+        for name in sorted(COUNTING_QUERIES):
+            ids = name.startswith('training.session.') and session_ids or seance_ids
+            if not ids:
+                continue
+            cr.execute(explain + _counting_query(name, ids), ids)
+            res[name] = '\n'.join(' '.join(str(x) for x in row) for row in cr.fetchall())
+        return res
 
     # training.session
+    @instrumented
     def action_workflow_draft(self, cr, uid, ids, context=None):
         return self.write(cr, uid, ids, {'state' : 'draft'}, context=context)
 
     # training.session
-    def test_workflow_open(self, cr, uid, ids, context=None):
-        for obj in self.browse(cr, uid, ids, context=context):
-            if not len(obj.seance_ids):
-                raise osv.except_osv(_('Warning'), _("Please, do not forget to have the seances in your session"))
-            else:
-                min_date = obj.date
-                for seance in obj.seance_ids:
-                    if seance.state == 'draft':
-                        raise osv.except_osv(_('Warning'), _('Please, you have at least a draft seance'))
-                    else:
-                        if seance.date < obj.date:
-                            raise osv.except_osv(_('Warning'), _("Please, Check the date of your seances because there is one seance with a date inferior to the session's date"))
+    def check_workflow_open(self, cr, uid, ids, context=None):
+        '''
+        Return the reasons preventing the sessions ids to open as
+        [(session id, seance id, reason)].
+        '''
+        if not ids:
+            return []
+
+        cr.execute("SELECT s.id, se.id, "
+                   "CASE WHEN se.id IS NULL THEN 'no_seance' "
+                   "WHEN se.state = 'draft' THEN 'draft_seance' "
+                   "ELSE 'seance_date' END "
+                   "FROM training_session s "
+                   "LEFT JOIN training_session_seance_rel rel ON rel.session_id = s.id "
+                   "LEFT JOIN training_seance se ON se.id = rel.seance_id "
+                   "WHERE s.id IN (" + ",".join(['%s'] * len(ids)) + ") "
+                   "AND (se.id IS NULL OR se.state = 'draft' OR se.date < s.date) "
+                   "ORDER BY s.id, se.date", ids)
+        return cr.fetchall()
 
-                    min_date = min(min_date, seance.date)
+    # training.session
+    @instrumented
+    def test_workflow_open(self, cr, uid, ids, context=None):
+        blockers = self.check_workflow_open(cr, uid, ids, context=context)
+        if blockers:
+            messages = {
+                'no_seance' : _("Please, do not forget to have the seances in your session"),
+                'draft_seance' : _('Please, you have at least a draft seance'),
+                'seance_date' : _("Please, Check the date of your seances because there is one seance with a date inferior to the session's date"),
+            }
+            names = dict((x['id'], x['name']) for x in self.read(cr, uid, ids, ['name'], context=context))
+            lines = []
+            for session_id, seance_id, reason in blockers:
+                line = "%s: %s" % (names[session_id], messages[reason])
+                if line not in lines:
+                    lines.append(line)
+            raise osv.except_osv(_('Warning'), "\n".join(lines))
 
         return True
 
     # training.session
+    @instrumented
     def action_workflow_open(self, cr, uid, ids, context=None):
         return self.write(cr, uid, ids, {'state' : 'opened'}, context=context)
 
     # training.session
+    @prefetched('seance_ids.contact_ids.state')
+    def _send_stakeholder_emails(self, cr, uid, ids, template, context=None):
+        # Send template to the accepted lecturers of each session with the
+        # seances they give
+        cache = get_prefetched(cr)
+        proxy = self.pool.get('training.participation.stakeholder')
+        proxy_seance = self.pool.get('training.seance')
+        for session in self.browse(cr, uid, ids, context=context):
+            objs = {}
+            seance_ids = cache.get('training.session', session.id, 'seance_ids')
+            for seance in proxy_seance.browse(cr, uid, seance_ids, context=context):
+                for contact_id in cache.get('training.seance', seance.id, 'contact_ids'):
+                    if cache.get('training.participation.stakeholder', contact_id, 'state') == 'accepted':
+                        objs.setdefault(contact_id, {}).setdefault('seances', []).append(seance)
+
+            proxy.send_email(cr, uid, objs.keys(), template, session, context, objs)
+
+    # training.session
+    @instrumented
     def action_workflow_open_confirm(self, cr, uid, ids, context=None):
 
         proxy = self.pool.get('training.subscription.line')
         subscription_line_ids = proxy.search(cr, uid, [('session_id', 'in', ids), ('state', '=', 'confirmed')], context=context)
         proxy.send_email(cr, uid, subscription_line_ids, 'session_open_confirmed', context)
 
-        proxy = self.pool.get('training.participation.stakeholder')
-        for session in self.browse(cr, uid, ids, context=context):
-            objs = {}
-            for seance in session.seance_ids:
-                for contact in seance.contact_ids:
-                    if contact.state == 'accepted':
-                        objs.setdefault(contact.id, {}).setdefault('seances', []).append(seance)
-
-            proxy.send_email(cr, uid, objs.keys(), 'session_open_confirmed', session, context, objs)
+        self._send_stakeholder_emails(cr, uid, ids, 'session_open_confirmed', context=context)
 
         return self.write(cr, uid, ids, {'state' : 'opened_confirmed'}, context=context)
 
@@ -639,6 +2045,7 @@ class TrainingSession(ModelView, ModelSQL):
         return True
 
     # training.session
+    @instrumented
     def action_workflow_close_confirm(self, cr, uid, ids, context=None):
         #proxy = self.pool.get('training.participation.stakeholder')
         #for session in self.browse(cr, uid, ids, context):
@@ -653,6 +2060,7 @@ class TrainingSession(ModelView, ModelSQL):
         return self.write(cr, uid, ids, {'state' : 'closed_confirmed'}, context=context)
 
     # training.session
+    @instrumented
     def action_create_invoice(self, cr, uid, ids, context=None):
         sl_proxy = self.pool.get('training.subscription.line')
         for session in self.browse(cr, uid, ids, context=context):
@@ -662,11 +2070,13 @@ class TrainingSession(ModelView, ModelSQL):
         return True
 
     # training.session
+    @instrumented
     def action_workflow_inprogress(self, cr, uid, ids, context=None):
         self.action_create_invoice(cr, uid, ids, context=context)
         return self.write(cr, uid, ids, {'state' : 'inprogress'}, context=context)
 
     # training.session
+    @instrumented
     def action_workflow_close(self, cr, uid, ids, context=None):
         workflow = netsvc.LocalService('workflow')
         proxy = self.pool.get('training.subscription.line')
@@ -678,11 +2088,29 @@ class TrainingSession(ModelView, ModelSQL):
         return self.write(cr, uid, ids, {'state' : 'closed'}, context=context)
 
     # trainin.session
+    def check_workflow_close(self, cr, uid, ids, context=None):
+        '''
+        Return the seances preventing the sessions ids to close as
+        [(session id, seance id, reason)].
+        '''
+        if not ids:
+            return []
+
+        cr.execute("SELECT rel.session_id, se.id, 'seance_not_done' "
+                   "FROM training_session_seance_rel rel, training_seance se "
+                   "WHERE se.id = rel.seance_id "
+                   "AND se.state NOT IN ('done', 'cancelled') "
+                   "AND rel.session_id IN (" + ",".join(['%s'] * len(ids)) + ") "
+                   "ORDER BY rel.session_id, se.date", ids)
+        return cr.fetchall()
+
+    # trainin.session
+    @instrumented
     def test_workflow_close(self, cr, uid, ids, context=None):
-        return all(seance.state in ('done','cancelled') for session in self.browse(cr, uid, ids, context=context)
-                                          for seance in session.seance_ids)
+        return not self.check_workflow_close(cr, uid, ids, context=context)
 
     # training.session
+    @instrumented
     def action_cancellation_session(self, cr, uid, ids, context=None):
 
         # just send emails...
@@ -691,19 +2119,13 @@ class TrainingSession(ModelView, ModelSQL):
         subscription_line_ids = proxy.search(cr, uid, [('session_id', 'in', ids), ('state', '=', 'confirmed')], context=context)
         proxy.send_email(cr, uid, subscription_line_ids, 'session_confirm_cancelled', context)
 
-        proxy = self.pool.get('training.participation.stakeholder')
-        for session in self.browse(cr, uid, ids, context=context):
-            objs = {}
-            for seance in session.seance_ids:
-                for contact in seance.contact_ids:
-                    if contact.state == 'accepted':
-                        objs.setdefault(contact.id, {}).setdefault('seances', []).append(seance)
-
-            proxy.send_email(cr, uid, objs.keys(), 'session_confirm_cancelled', session, context, objs)
+        self._send_stakeholder_emails(cr, uid, ids, 'session_confirm_cancelled', context=context)
 
     # training.session
+    @instrumented
     def action_workflow_cancel(self, cr, uid, ids, context=None):
         self.write(cr, uid, ids, {'state' : 'cancelled'}, context=context)
+        self.pool.get('training.waitlist').cancel_waiters(cr, uid, ids, context=context)
 
         workflow = netsvc.LocalService('workflow')
         for session in self.browse(cr, uid, ids, context=context):
@@ -725,6 +2147,7 @@ class TrainingSession(ModelView, ModelSQL):
 
 
     
+    @instrumented
     def search(self, cr, uid, domain, offset=0, limit=None, order=None, context=None, count=False):
         subscription_id = context and context.get('subscription_id', False) or False
 
@@ -736,13 +2159,252 @@ class TrainingSession(ModelView, ModelSQL):
 
         return super(training_session, self).search(cr, uid, domain, offset=offset, limit=limit, order=order, context=context, count=count)
 
+    @instrumented
+    def write(self, cr, uid, ids, vals, context=None):
+        _invalidate_prefetched(cr)
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        old_states = 'state' in vals and _read_states(cr, 'training_session', ids) or {}
+        old_pairs = 'seance_ids' in vals and _session_seance_pairs(cr, 'session_id', ids) or set()
+        res = super(TrainingSession, self).write(cr, uid, ids, vals, context=context)
+        if 'seance_ids' in vals:
+            _append_link_events(cr, uid, old_pairs, _session_seance_pairs(cr, 'session_id', ids))
+        # Cleared after the write so no reader caches the previous values
+        if any(f in vals for f in SEATS_FIELDS):
+            _invalidate_available_seats()
+        if 'state' in vals:
+            _append_state_events(cr, uid, self._name, old_states, vals['state'])
+        return res
+
     def copy(self, cr, uid, object_id, values, context=None):
         raise osv.except_osv(_("Error"),
                              _("You can not duplicate a session"))
 
+    # training.session
+    def reschedule(self, cr, uid, ids, delta=None, start=None, compress=False, context=None):
+        '''
+        Move the sessions ids and their seances by delta or to start, packing
+        the seance days on working days with compress.
+        '''
+        if not ids or (delta is None and start is None):
+            return True
+
+        cr.execute("SELECT id, date, date_end FROM training_session "
+                   "WHERE id IN (" + ",".join(['%s'] * len(ids)) + ") ORDER BY date", ids)
+        sessions = cr.fetchall()
+        cr.execute("SELECT rel.session_id, s.id, s.date, COALESCE(s.chain_id, s.master_id, s.id) "
+                   "FROM training_session_seance_rel rel, training_seance s "
+                   "WHERE s.id = rel.seance_id "
+                   "AND rel.session_id IN (" + ",".join(['%s'] * len(ids)) + ") "
+                   "ORDER BY s.date, s.id", ids)
+        session_seances = {}
+        for session_id, seance_id, seance_date, chain_id in cr.fetchall():
+            session_seances.setdefault(session_id, []).append((seance_id, _to_datetime(seance_date), chain_id))
+
+        all_dates = [_to_datetime(x[1]) for x in sessions]
+        all_dates += [x[1] for v in session_seances.values() for x in v]
+        shift = delta or timedelta(0)
+        if start is not None:
+            lower = min(_to_datetime(start), min(all_dates))
+        else:
+            lower = min(all_dates) + min(shift, timedelta(0))
+        periods = _holiday_periods(cr, lower, max(all_dates) + abs(shift) + timedelta(days=365))
+
+        session_dates, session_ends, seance_dates = {}, {}, {}
+        for session_id, session_date, session_end in sessions:
+            session_date = _to_datetime(session_date)
+            if start is not None:
+                new_date = _to_datetime(start)
+            else:
+                new_date = session_date + shift
+            offset = new_date - session_date
+            session_dates[session_id] = new_date
+            if session_end:
+                session_ends[session_id] = _to_datetime(session_end) + offset
+
+            last_dates = {}
+            day_map = {}
+            next_day = new_date
+            for seance_id, seance_date, chain in session_seances.get(session_id, []):
+                if seance_id in seance_dates:
+                    # Shared with a session already moved
+                    continue
+                if compress:
+                    day = seance_date.date()
+                    if day not in day_map:
+                        next_day = _next_working_day(next_day, periods)
+                        day_map[day] = next_day.date()
+                        next_day = next_day + timedelta(days=1)
+                    target = datetime.combine(day_map[day], seance_date.time())
+                else:
+                    target = _next_working_day(seance_date + offset, periods)
+
+                if chain in last_dates and target < last_dates[chain]:
+                    target = _next_working_day(last_dates[chain] + timedelta(days=1), periods)
+                last_dates[chain] = target
+                seance_dates[seance_id] = target
+
+        _bulk_update(cr, 'training_session', 'date', session_dates, uid)
+        _bulk_update(cr, 'training_session', 'date_end', session_ends, uid)
+        _bulk_update(cr, 'training_seance', 'date', seance_dates, uid)
+        _update_seance_chains(cr, list(seance_dates))
+        _invalidate_prefetched(cr)
+
+        self._check_bulk_seances(cr, uid, list(seance_dates), context=context)
+        return True
+
+    # training.session
+    def _check_bulk_seances(self, cr, uid, seance_ids, context=None):
+        # Validation of the constraints bypassed by the bulk writes, once for
+        # all the seances
+        if not seance_ids:
+            return
+        in_ids = ",".join(['%s'] * len(seance_ids))
+        cr.execute("SELECT 1 FROM training_seance "
+                   "WHERE min_limit > max_limit "
+                   "AND id IN (" + in_ids + ")", seance_ids)
+        if cr.fetchone():
+            raise osv.except_osv(_('Warning'), _("The minimum limit is greater than the maximum limit"))
+        cr.execute("SELECT 1 "
+                   "FROM training_session_seance_rel rel, training_session ss, training_seance s "
+                   "WHERE ss.id = rel.session_id "
+                   "AND s.id = rel.seance_id "
+                   "AND s.date < ss.date "
+                   "AND rel.seance_id IN (" + in_ids + ")", seance_ids)
+        if cr.fetchone():
+            raise osv.except_osv(_('Warning'), _("You have a session with a date inferior to the seance's date"))
+        if not self.pool.get('training.seance')._check_lecturer_conflicts(cr, uid, seance_ids, context=context):
+            raise osv.except_osv(_('Warning'), _("A lecturer is already booked on an overlapping seance"))
+
+    # training.session
+    def clone_sessions(self, cr, uid, template_id, dates, context=None):
+        '''
+        Copy the template session with its groups, seances and purchase lines
+        for each date of dates, return the new ids ordered like dates.
+        '''
+        if not dates:
+            return []
+        dates = [_to_datetime(x) for x in dates]
+        now = datetime.now()
+        audit = {'create_uid' : uid, 'create_date' : now, 'write_uid' : None, 'write_date' : None}
+
+        session_columns, sessions = _select_rows(cr, "SELECT * FROM training_session WHERE id = %s", (template_id,))
+        if not sessions:
+            raise osv.except_osv(_("Error"), _("The session to clone does not exist"))
+        template = sessions[0]
+        template_date = _to_datetime(template['date'])
+        group_columns, groups = _select_rows(cr, "SELECT * FROM training_group WHERE session_id = %s ORDER BY id", (template_id,))
+        seance_columns, seances = _select_rows(cr, "SELECT s.* FROM training_seance s, training_session_seance_rel rel "
+                                               "WHERE s.id = rel.seance_id AND rel.session_id = %s "
+                                               "ORDER BY s.date, s.id", (template_id,))
+        line_columns, lines = [], []
+        if seances:
+            seance_ids = [x['id'] for x in seances]
+            line_columns, lines = _select_rows(cr, "SELECT * FROM training_seance_purchase_line "
+                                               "WHERE seance_id IN (" + ",".join(['%s'] * len(seance_ids)) + ") "
+                                               "ORDER BY id", seance_ids)
+
+        span = max([_to_datetime(x['date']) for x in seances] + [template_date]) - template_date
+        periods = _holiday_periods(cr, min(dates), max(dates) + span + timedelta(days=365))
+
+        def insert(table, columns, rows):
+            columns = [c for c in columns if c != 'id']
+            return _bulk_insert(cr, table, columns, [[row[c] for c in columns] for row in rows])
+
+        # Sessions
+        new_sessions = []
+        for target in dates:
+            values = dict(template, date=target, state='draft', **audit)
+            if template.get('date_end'):
+                values['date_end'] = _to_datetime(template['date_end']) + (target - template_date)
+            new_sessions.append(values)
+        session_ids = insert('training_session', session_columns, new_sessions)
+
+        # Groups
+        new_groups, group_keys = [], []
+        for index, session_id in enumerate(session_ids):
+            for group in groups:
+                new_groups.append(dict(group, session_id=session_id, **audit))
+                group_keys.append((index, group['id']))
+        group_map = dict(izip(group_keys, insert('training_group', group_columns, new_groups)))
+
+        # Seances, the masters are inserted first to remap master_id
+        def new_seance(seance, index, target):
+            values = dict(seance, state='opened', confirmed_lecturer='no', **audit)
+            # The rooms are booked again for the new dates
+            if 'resource_id' in values:
+                values['resource_id'] = None
+            # The chains are set once the new masters have their ids
+            if 'chain_id' in values:
+                values['chain_id'] = None
+            values['original_session_id'] = session_ids[index]
+            values['group_id'] = group_map.get((index, seance.get('group_id')))
+            values['date'] = target
+            return values
+
+        masters, children = [], []
+        for index, target_date in enumerate(dates):
+            delta = target_date - template_date
+            last_dates = {}
+            for seance in seances:
+                chain = seance.get('master_id') or seance['id']
+                target = _next_working_day(_to_datetime(seance['date']) + delta, periods)
+                if chain in last_dates and target < last_dates[chain]:
+                    target = _next_working_day(last_dates[chain] + timedelta(days=1), periods)
+                last_dates[chain] = target
+                values = new_seance(seance, index, target)
+                if seance.get('master_id'):
+                    children.append((index, seance, values))
+                else:
+                    masters.append((index, seance, values))
+
+        seance_map = {}
+        master_ids = insert('training_seance', seance_columns, [x[2] for x in masters])
+        for (index, seance, values), new_id in izip(masters, master_ids):
+            seance_map[(index, seance['id'])] = new_id
+        for index, seance, values in children:
+            values['master_id'] = seance_map.get((index, seance['master_id']))
+        child_ids = insert('training_seance', seance_columns, [x[2] for x in children])
+        for (index, seance, values), new_id in izip(children, child_ids):
+            seance_map[(index, seance['id'])] = new_id
+
+        _update_seance_chains(cr, seance_map.values())
+
+        _bulk_insert(cr, 'training_session_seance_rel', ['session_id', 'seance_id'],
+                     [[session_ids[index], new_id] for (index, template_seance_id), new_id in seance_map.items()],
+                     returning=False)
+
+        # Purchase lines
+        new_lines = []
+        for index in range(len(dates)):
+            for line in lines:
+                values = dict(line, seance_id=seance_map[(index, line['seance_id'])], **audit)
+                if 'procurement_id' in values:
+                    values['procurement_id'] = None
+                new_lines.append(values)
+        insert('training_seance_purchase_line', line_columns, new_lines)
+
+        # The rows inserted without create get their workflow instances and
+        # the constraints are validated once for all
+        workflow = netsvc.LocalService('workflow')
+        for session_id in session_ids:
+            workflow.trg_create(uid, 'training.session', session_id, cr)
+        for seance_id in sorted(seance_map.values()):
+            workflow.trg_create(uid, 'training.seance', seance_id, cr)
+        _invalidate_prefetched(cr)
+        self._check_bulk_seances(cr, uid, sorted(seance_map.values()), context=context)
+
+        return session_ids
+
 class TrainingParticipation(ModelView, ModelSQL):
     'Participation'
     _name = 'training.participation'
+
+    @classmethod
+    def __register__(cls, module_name):
+        super(TrainingParticipation, cls).__register__(module_name)
+        _create_indexes(Transaction().cursor)
+        _prepare_archives(Transaction().cursor)
     
     def _store_get_sublines(self, cr, uid, sl_ids, context=None):
         sublines = self.pool.get('training.subscription.line')
@@ -782,19 +2444,22 @@ class TrainingParticipation(ModelView, ModelSQL):
         }
 
 
+    @instrumented
     def name_get(self, cr, uid, ids, context=None):
         res = []
+        others = []
         for obj in self.browse(cr, uid, list(set(ids)), context=context):
             sl = obj.subscription_line_id
-            oid = obj.id
             if sl.contact_id:
-                name = "%s %s (%s)" % (sl.job_id.contact_id.first_name, sl.job_id.contact_id.name, sl.partner_id.name,)
+                res.append((obj.id, "%s %s (%s)" % (sl.job_id.contact_id.first_name, sl.job_id.contact_id.name, sl.partner_id.name,)))
             else:
-                name = super(training_participation, self).name_get(cr, uid, [oid], context=context)[0][1]
-            res.append((oid, name,))
+                others.append(obj.id)
+        if others:
+            res.extend(super(TrainingParticipation, self).name_get(cr, uid, others, context=context))
         return res
 
     # training.participation
+    @instrumented
     def create_procurements(self, cr, uid, participation_ids, delayed=False, context=None):
         purchase_order_pool = self.pool.get('purchase.order')
         products = {}
@@ -809,7 +2474,7 @@ class TrainingParticipation(ModelView, ModelSQL):
 
                     products[purchase_line][1].append(participation)
 
-        location_id = self.pool.get('stock.location').search(cr, uid, [('usage', '=', 'internal')], context=context)[0]
+        location_id = _get_internal_location(self.pool, cr, uid, context=context)
 
         participations = {}
         for po_line, (quantity, parts) in products.items():
@@ -829,13 +2494,293 @@ class TrainingParticipation(ModelView, ModelSQL):
         # mark the purchase as done for this participations
         return self.write(cr, uid, participation_ids, {'purchase_state' : 'done'}, context=context)
 
+    @instrumented
+    def create(self, cr, uid, vals, context=None):
+        _invalidate_prefetched(cr)
+        participation_id = super(TrainingParticipation, self).create(cr, uid, vals, context=context)
+        _invalidate_available_seats()
+        _append_events(cr, uid, self._name, 'create', [(participation_id, {
+            'seance_id' : vals.get('seance_id'),
+            'subscription_line_id' : vals.get('subscription_line_id'),
+        })])
+        return participation_id
+
+    @instrumented
+    def write(self, cr, uid, ids, vals, context=None):
+        _invalidate_prefetched(cr)
+        res = super(TrainingParticipation, self).write(cr, uid, ids, vals, context=context)
+        if 'seance_id' in vals or 'subscription_line_id' in vals:
+            _invalidate_available_seats()
+        return res
+
+    def _get_session_ids(self, cr, ids):
+        if not ids:
+            return []
+
+        cr.execute("SELECT DISTINCT rel.session_id "
+                   "FROM training_participation tp, training_session_seance_rel rel "
+                   "WHERE rel.seance_id = tp.seance_id "
+                   "AND tp.id IN (" + ",".join(['%s'] * len(ids)) + ")", ids)
+        return [x[0] for x in cr.fetchall()]
+
+    # training.participation
+    @instrumented
+    def export_rows(self, cr, uid, fileobj, format='csv', date_from=None, date_to=None,
+                    seance_states=None, line_states=None, chunk_size=5000, archived=True, context=None):
+        '''
+        Stream to fileobj the filtered participations as CSV or Parquet,
+        return the number of exported rows.
+        '''
+        assert format in ('csv', 'parquet')
+        if format == 'parquet' and pyarrow is None:
+            raise osv.except_osv(_('Warning'), _("The Parquet export needs the pyarrow library"))
+
+        def table(name):
+            if archived and _view_exists(cr, name + '_all'):
+                return name + '_all'
+            return name
+
+        query = ("SELECT " + ", ".join(x[1] for x in EXPORT_COLUMNS) + " "
+                 "FROM " + table('training_participation') + " tp "
+                 "JOIN " + table('training_seance') + " s ON s.id = tp.seance_id "
+                 "JOIN " + table('training_subscription_line') + " tsl ON tsl.id = tp.subscription_line_id "
+                 "JOIN " + table('training_session') + " ss ON ss.id = tsl.session_id "
+                 "LEFT JOIN res_partner_contact c ON c.id = tsl.contact_id "
+                 "LEFT JOIN res_partner p ON p.id = tsl.partner_id "
+                 "WHERE 1 = 1")
+        args = []
+        if date_from:
+            query += " AND s.date >= %s"
+            args.append(date_from)
+        if date_to:
+            query += " AND s.date < %s"
+            args.append(date_to)
+        for column, states in (('s.state', seance_states), ('tsl.state', line_states)):
+            if states:
+                query += " AND " + column + " IN (" + ",".join(['%s'] * len(states)) + ")"
+                args.extend(states)
+        query += " ORDER BY tp.id"
+
+        names = [x[0] for x in EXPORT_COLUMNS]
+        if format == 'csv':
+            writer = csv.writer(fileobj)
+            writer.writerow(names)
+        else:
+            types = {
+                'int64' : pyarrow.int64(),
+                'bool' : pyarrow.bool_(),
+                'string' : pyarrow.string(),
+                'float64' : pyarrow.float64(),
+                'timestamp' : pyarrow.timestamp('s'),
+            }
+            schema = pyarrow.schema([(name, types[kind]) for name, expression, kind in EXPORT_COLUMNS])
+            writer = pyarrow.parquet.ParquetWriter(fileobj, schema)
+        dates = [i for i, x in enumerate(EXPORT_COLUMNS) if x[2] == 'timestamp']
+
+        def write(rows):
+            if format == 'csv':
+                writer.writerows([[isinstance(v, unicode) and v.encode('utf-8') or v for v in row]
+                                  for row in rows])
+                return
+            rows = [list(row) for row in rows]
+            for row in rows:
+                for i in dates:
+                    row[i] = _to_datetime(row[i])
+            columns = izip(*rows)
+            writer.write_table(pyarrow.Table.from_arrays(
+                [pyarrow.array(list(values), type=field.type) for values, field in izip(columns, schema)],
+                schema=schema))
+
+        cursor = _report_cursor(cr) or cr
+        server_side = backend.name() == 'postgresql'
+
+        def fetch():
+            if server_side:
+                cursor.execute("FETCH FORWARD %s FROM training_participation_export", (chunk_size,))
+                return cursor.fetchall()
+            return cursor.fetchmany(chunk_size)
+
+        count = 0
+        declared = False
+        try:
+            if server_side:
+                cursor.execute("DECLARE training_participation_export NO SCROLL CURSOR FOR " + query, args)
+                declared = True
+            else:
+                cursor.execute(query, args)
+            while True:
+                rows = fetch()
+                if not rows:
+                    break
+                write(rows)
+                count += len(rows)
+        finally:
+            # Closed even on error so the next export of the transaction can
+            # declare it again
+            if declared:
+                cursor.execute("CLOSE training_participation_export")
+            if format == 'parquet':
+                writer.close()
+            if cursor is not cr:
+                cursor.close()
+        return count
+
+    # training.participation
+    @instrumented
+    def generate_certificates(self, cr, uid, session_ids, path=None, processes=None,
+                              chunk_size=20, context=None):
+        '''
+        Render the certificates of the present participations of session_ids
+        into the zip file path or as attachments, return their number.
+        '''
+        if not session_ids:
+            return 0
+        report_name = CONFIG.get('training_certificate_report',
+                                 'report.training.participation.certificate')
+        if processes is None:
+            processes = int(CONFIG.get('training_certificate_processes',
+                                       multiprocessing.cpu_count()))
+
+        # The workers have their own transactions, they only see the present
+        # flags committed before the call
+        cr.execute("SELECT tp.id "
+                   "FROM training_participation tp, training_subscription_line tsl "
+                   "WHERE tsl.id = tp.subscription_line_id "
+                   "AND tp.present "
+                   "AND tsl.state IN ('confirmed', 'done') "
+                   "AND tsl.session_id IN (" + ",".join(['%s'] * len(session_ids)) + ") "
+                   "ORDER BY tp.id", session_ids)
+        participation_ids = [x[0] for x in cr.fetchall()]
+
+        filename = 'certificate-%d.pdf'
+        attachment_proxy = self.pool.get('ir.attachment')
+        if path:
+            # The parts of an interrupted run are kept, the temporary files
+            # were being written
+            directory, prefix = os.path.split(os.path.abspath(path))
+            parts = []
+            for name in os.listdir(directory):
+                if name.startswith(prefix + '.') and name.endswith('.tmp'):
+                    os.remove(os.path.join(directory, name))
+                elif name.startswith(prefix + '.') and name.endswith('.part'):
+                    parts.append(os.path.join(directory, name))
+            done = set()
+            for name in [path] + parts:
+                if os.path.exists(name):
+                    archive = zipfile.ZipFile(name, 'r')
+                    done.update(archive.namelist())
+                    archive.close()
+        else:
+            attachment_ids = attachment_proxy.search(cr, uid, [
+                ('res_model', '=', self._name),
+                ('res_id', 'in', participation_ids),
+                ('name', 'like', 'certificate-%'),
+                ], context=context)
+            done = set(x['name'] for x in attachment_proxy.read(cr, uid, attachment_ids, ['res_id', 'name'], context=context)
+                       if x['name'] == filename % x['res_id'])
+        todo = [x for x in participation_ids if filename % x not in done]
+
+        def store(certificates):
+            if path:
+                # A part is renamed once complete so it is never truncated
+                part = '%s.%d.part' % (path, min(x[0] for x in certificates))
+                archive = zipfile.ZipFile(part + '.tmp', 'w', zipfile.ZIP_DEFLATED)
+                try:
+                    for participation_id, pdf in certificates:
+                        archive.writestr(filename % participation_id, pdf)
+                finally:
+                    archive.close()
+                os.rename(part + '.tmp', part)
+                parts.append(part)
+            else:
+                # Created in the transaction of cr, committed by the caller
+                for participation_id, pdf in certificates:
+                    attachment_proxy.create(cr, uid, {
+                        'name' : filename % participation_id,
+                        'datas_fname' : filename % participation_id,
+                        'datas' : base64.encodestring(pdf),
+                        'res_model' : self._name,
+                        'res_id' : participation_id,
+                    }, context=context)
+
+        def merge():
+            # Each certificate is copied once, into a copy of the archive
+            # renamed over it before the parts are removed
+            if not parts:
+                return
+            if os.path.exists(path):
+                shutil.copyfile(path, path + '.tmp')
+            archive = zipfile.ZipFile(path + '.tmp', 'a', zipfile.ZIP_DEFLATED)
+            try:
+                for part in sorted(parts):
+                    source = zipfile.ZipFile(part, 'r')
+                    for name in source.namelist():
+                        archive.writestr(name, source.read(name))
+                    source.close()
+            finally:
+                archive.close()
+            os.rename(path + '.tmp', path)
+            for part in parts:
+                os.remove(part)
+
+        chunks = [todo[i:i + chunk_size] for i in range(0, len(todo), chunk_size)]
+        count = 0
+        if chunks and processes <= 1:
+            report = netsvc.LocalService(report_name)
+            for chunk in chunks:
+                certificates = [(x, report.create(cr, uid, [x], {}, context=context)[0]) for x in chunk]
+                store(certificates)
+                count += len(certificates)
+        elif chunks:
+            pool = multiprocessing.Pool(processes, initializer=_init_certificate_worker)
+            try:
+                jobs = [(cr.database_name, uid, report_name, chunk, context) for chunk in chunks]
+                for certificates in pool.imap_unordered(_render_certificates, jobs):
+                    store(certificates)
+                    count += len(certificates)
+            finally:
+                pool.terminate()
+                pool.join()
+        if path:
+            merge()
+        return count
+
+    @instrumented
     def unlink(self, cr, uid, ids, context=None):
         # TODO cancel the procurements ??
-        return super(TrainingParticipation, self).unlink(cr, uid, ids, context=context)
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        _invalidate_prefetched(cr)
+        session_ids = self._get_session_ids(cr, ids)
+        removed = []
+        if ids:
+            cr.execute("SELECT id, seance_id, subscription_line_id FROM training_participation "
+                       "WHERE id IN (" + ",".join(['%s'] * len(ids)) + ") ORDER BY id", ids)
+            removed = [(x, {'seance_id' : y, 'subscription_line_id' : z}) for x, y, z in cr.fetchall()]
+        res = super(TrainingParticipation, self).unlink(cr, uid, ids, context=context)
+        _invalidate_available_seats()
+        _append_events(cr, uid, self._name, 'delete', removed)
+
+        # The freed seats are given to the waiting list
+        if not (context or {}).get('no_waitlist_promotion'):
+            self.pool.get('training.waitlist').promote(cr, uid, session_ids, context=context)
+        return res
 
 class TrainingSeanse(ModelView, ModelSQL):
     'Seance'
     _name = 'training.seance'
+    _available_seats_cache = Cache('training.seance.available_seats',
+        context=False)
+
+    @classmethod
+    def __register__(cls, module_name):
+        super(TrainingSeanse, cls).__register__(module_name)
+        cursor = Transaction().cursor
+        _create_indexes(cursor)
+        _prepare_archives(cursor)
+        cursor.execute("SELECT 1 FROM training_seance WHERE chain_id IS NULL LIMIT 1")
+        if cursor.fetchone():
+            _update_seance_chains(cursor)
 
     def _shared_compute(self, cr, uid, ids, fieldnames, args, context=None):
         res = dict.fromkeys(ids, 0)
@@ -846,42 +2791,49 @@ class TrainingSeanse(ModelView, ModelSQL):
     # training.seance
     def _available_seats_compute(self, cr, uid, ids, fieldnames, args, context=None):
         res = dict.fromkeys(ids, 0)
+        if not ids:
+            return res
 
-        for seance in self.browse(cr, uid, ids, context=context):
-            count = ['participant_count', 'participant_count_manual'][seance.manual]
-            res[seance.id] = seance.max_limit - int(seance[count])
+        counts = self._participant_count(cr, uid, ids, fieldnames, args, context=context)
+        for values in self.read(cr, uid, ids, ['max_limit', 'manual', 'participant_count_manual'], context=context):
+            if values['manual']:
+                count = values['participant_count_manual']
+            else:
+                count = counts[values['id']]
+            res[values['id']] = values['max_limit'] - int(count or 0)
 
         return res
 
     # training.seance
+    @instrumented
+    def get_available_seats(self, cr, uid, ids, context=None):
+        '''
+        Return the available seats of many seances, cached until a
+        participation or state change.
+        '''
+        return _cached_seats(self._available_seats_cache, ids,
+            lambda missing: self._available_seats_compute(cr, uid, missing, None, None, context=context))
+
+    # training.seance
+    @instrumented
     def _draft_seats_compute(self, cr, uid, ids, fieldnames, args, context=None):
         res = dict.fromkeys(ids, 0)
+        if not ids:
+            return res
 
-        cr.execute("SELECT rel.seance_id, count(1) "
-                   "FROM training_subscription_line sl, training_session_seance_rel rel "
-                   "WHERE sl.state = 'draft' "
-                   "AND sl.session_id = rel.session_id "
-                   "AND rel.seance_id IN (" + ",".join(['%s'] * len(ids)) + ") "
-                   "GROUP BY rel.seance_id ", ids)
-
-        for seance_id, count in cr.fetchall():
+        for seance_id, count in _report_fetchall(cr, _counting_query('training.seance.draft_seats', ids), ids):
             res[seance_id] = int(count)
 
         return res
 
     # training.seance
+    @instrumented
     def _participant_count(self, cr, uid, ids, name, args, context=None):
         res = dict.fromkeys(ids, 0)
+        if not ids:
+            return res
 
-        cr.execute('SELECT tp.seance_id, COUNT(DISTINCT(tsl.contact_id)) '
-                   'FROM training_participation tp, training_subscription_line tsl '
-                   'WHERE tp.subscription_line_id = tsl.id '
-                   'AND tp.seance_id in (' + ",".join(['%s'] * len(ids)) + ") "
-                   "AND tsl.state in ('confirmed', 'done') "
-                   'GROUP BY tp.seance_id',
-                   ids
-                  )
-        for seance_id, count in cr.fetchall():
+        for seance_id, count in _report_fetchall(cr, _counting_query('training.seance.participant_count', ids), ids):
             res[seance_id] = int(count)
 
         return res
@@ -890,20 +2842,30 @@ class TrainingSeanse(ModelView, ModelSQL):
 
     def _confirmed_lecturer_compute(self, cr, uid, ids, fieldnames, args, context=None):
         res = dict.fromkeys(ids, 'no')
-        proxy = self.pool.get('training.participation.stakeholder')
-        for seance in self.browse(cr, uid, ids, context=context):
-            #if seance.kind == 'standard':
-                has = len(seance.contact_ids) > 0 and any(c.state in ['accepted', 'done'] for c in seance.contact_ids)
-                res[seance.id] = ['no', 'yes'][has]
+        if not ids:
+            return res
+
+        cr.execute("SELECT DISTINCT seance_id "
+                   "FROM training_participation_stakeholder "
+                   "WHERE state IN ('accepted', 'done') "
+                   "AND seance_id IN (" + ",".join(['%s'] * len(ids)) + ")", ids)
+        for seance_id, in cr.fetchall():
+            res[seance_id] = 'yes'
 
         return res
 
     def _get_stakeholders(self, cr, uid, ids, context=None):
-        values = set()
-        for part in self.pool.get('training.participation.stakeholder').browse(cr, uid, ids, context=context):
-            values.add(part.seance_id.id)
+        # The seances are marked for recomputation at commit so a bulk
+        # import of stakeholders recomputes each seance once
+        if not ids:
+            return []
 
-        return list(values)
+        cr.execute("SELECT DISTINCT seance_id "
+                   "FROM training_participation_stakeholder "
+                   "WHERE id IN (" + ",".join(['%s'] * len(ids)) + ")", ids)
+        mark_dirty(cr, uid, 'training.seance', 'confirmed_lecturer', [x[0] for x in cr.fetchall()])
+
+        return []
 
     def _get_sessions_type(self, cr, uid, ids, fieldnames, args, context=None):
         res = []
@@ -937,6 +2899,7 @@ class TrainingSeanse(ModelView, ModelSQL):
         return res
 
     # training.seance
+    @instrumented
     def name_get(self, cr, uid, ids, context=None):
         return [(obj.id, "%s (%s)" % (obj.name, obj.group_id.name or _('Class %d') % (1,))) for obj in self.browse(cr, uid, list(set(ids)), context=context)]
 
@@ -1033,6 +2996,10 @@ class TrainingSeanse(ModelView, ModelSQL):
                                                    ('validated', 'Validated')],
                                         readonly=True),
         'purchase_line_ids' : fields.one2many('training.seance.purchase_line', 'seance_id', 'Supplier Commands'),
+        'resource_id' : fields.many2one('training.resource', 'Room',
+                                        select=1,
+                                        domain="[('kind', '=', 'room')]",
+                                        help='The room where the seance takes place'),
         'min_limit' : fields.integer("Minimum Threshold", help='The Minimum of Participants in Seance'),
         'max_limit' : fields.integer("Maximum Threshold", help='The Maximum of Participants in Seance'),
         'user_id' : fields.many2one('res.users', 'Responsible', required=True, select=1),
@@ -1062,6 +3029,10 @@ class TrainingSeanse(ModelView, ModelSQL):
 
         'kind': fields.selection(training_course_kind_compute, 'Kind', required=True, select=1),
         'master_id' : fields.many2one('training.seance', 'Master Seance'),
+        'chain_id' : fields.many2one('training.seance', 'Chain', select=1, readonly=True,
+                                     help="The master seance of the split course"),
+        'chain_position' : fields.integer('Chain Position', readonly=True,
+                                          help="The rank by date of the seance in the split course"),
 
         'participant_count' : fields.function(_participant_count,
                                               method=True,
@@ -1096,11 +3067,33 @@ class TrainingSeanse(ModelView, ModelSQL):
 
         return True
 
+    def _check_lecturer_conflicts(self, cr, uid, ids, context=None):
+        # The seances with forced lecturers are allowed to overlap
+        cr.execute("SELECT DISTINCT sh.job_id, s.date, s.duration "
+                   "FROM training_participation_stakeholder sh, training_seance s "
+                   "WHERE sh.seance_id = s.id "
+                   "AND sh.state NOT IN ('cancelled', 'refused') "
+                   "AND s.state != 'cancelled' "
+                   "AND (s.forced_lecturer IS NULL OR NOT s.forced_lecturer) "
+                   "AND sh.job_id IS NOT NULL "
+                   "AND s.id IN (" + ",".join(['%s'] * len(ids)) + ")", ids)
+        rows = cr.fetchall()
+        if not rows:
+            return True
+
+        starts = [_to_datetime(x[1]) for x in rows]
+        ends = [start + timedelta(hours=x[2] or 0) for start, x in izip(starts, rows)]
+        conflicts = self.find_lecturer_conflicts(cr, uid, min(starts), max(ends),
+                                                 job_ids=list(set(x[0] for x in rows)), context=context)
+        ids = set(ids)
+        return not any(a in ids or b in ids for job_id, a, b in conflicts)
+
     _constraints = [
         #(_check_date_before_now, "You cannot create a date before now", ['date']),
         #(_check_date_holiday, "You cannot assign a date in a public holiday", ['date']),
         (_check_limits, 'The minimum limit is greater than the maximum limit', ['min_limit', 'max_limit']),
         (_check_date_of_sessions, "You have a session with a date inferior to the seance's date", ['date']),
+        (_check_lecturer_conflicts, "A lecturer is already booked on an overlapping seance", ['date', 'duration']),
     ]
 
     _defaults = {
@@ -1120,19 +3113,41 @@ class TrainingSeanse(ModelView, ModelSQL):
     }
 
     # training.seance
+    @instrumented
     def action_workflow_open(self, cr, uid, ids, context=None):
         return self.write(cr, uid, ids, {'state' : 'opened'}, context=context)
 
     # training.seance
+    def check_workflow_confirm(self, cr, uid, ids, context=None):
+        '''
+        Return the sessions preventing the seances ids to be confirmed as
+        [(seance id, session id, reason)].
+        '''
+        if not ids:
+            return []
+
+        cr.execute("SELECT rel.seance_id, ss.id, 'session_not_confirmed' "
+                   "FROM training_session_seance_rel rel, training_session ss "
+                   "WHERE ss.id = rel.session_id "
+                   "AND ss.state IN ('draft', 'opened') "
+                   "AND rel.seance_id IN (" + ",".join(['%s'] * len(ids)) + ") "
+                   "ORDER BY rel.seance_id, ss.id", ids)
+        return cr.fetchall()
+
+    # training.seance
+    @instrumented
     def test_workflow_confirm(self, cr, uid, ids, context=None):
-        for seance in self.browse(cr, uid, ids, context=context):
-            if any(session.state in ('draft', 'opened') for session in seance.session_ids):
-                raise osv.except_osv(_('Warning'),
-                                     _('There is at least a session in the "Draft" or "Confirmed" state'))
+        blockers = self.check_workflow_confirm(cr, uid, ids, context=context)
+        if blockers:
+            names = dict((x['id'], x['name']) for x in self.read(cr, uid, ids, ['name'], context=context))
+            lines = [_('There is at least a session in the "Draft" or "Confirmed" state')]
+            lines.extend(sorted(set(names[seance_id] for seance_id, _session_id, _reason in blockers)))
+            raise osv.except_osv(_('Warning'), "\n".join(lines))
 
         return True
 
     # training.seance
+    @instrumented
     def action_workflow_confirm(self, cr, uid, ids, context=None):
         proxy = self.pool.get('training.participation')
         emails = self.pool.get('training.email')
@@ -1177,16 +3192,19 @@ class TrainingSeanse(ModelView, ModelSQL):
         return self.write(cr, uid, ids, {'state' : 'confirmed'}, context=context)
 
     # training.seance
+    @instrumented
+    @prefetched('session_ids')
     def action_workflow_inprogress(self, cr, uid, ids, context=None):
-        workflow = netsvc.LocalService('workflow')
+        cache = get_prefetched(cr)
+        # The sessions transitions drop the prefetched values
+        session_ids = [x for seance_id in ids for x in cache.get('training.seance', seance_id, 'session_ids')]
 
-        for seance in self.browse(cr, uid, ids, context=context):
-            for session in seance.session_ids:
-                workflow.trg_validate(uid, 'training.session', session.id, 'signal_inprogress', cr)
+        _signal_sessions(cr, uid, session_ids, 'signal_inprogress')
 
         return self.write(cr, uid, ids, {'state' : 'inprogress'}, context=context)
 
     # training.seance
+    @instrumented
     def action_workflow_close(self, cr, uid, ids, context=None):
         return self.write(cr, uid, ids, {'state' : 'closed'}, context=context)
 
@@ -1195,25 +3213,113 @@ class TrainingSeanse(ModelView, ModelSQL):
         return True
 
     # training.seance
+    @instrumented
+    @prefetched('contact_ids', 'session_ids')
     def action_workflow_done(self, cr, uid, ids, context=None):
         workflow = netsvc.LocalService('workflow')
+        cache = get_prefetched(cr)
+        # The write drops the prefetched values
+        contact_ids = [x for seance_id in ids for x in cache.get('training.seance', seance_id, 'contact_ids')]
+        session_ids = [x for seance_id in ids for x in cache.get('training.seance', seance_id, 'session_ids')]
+
         self.write(cr, uid, ids, {'state' : 'done'}, context=context)
 
-        for seance in self.browse(cr, uid, ids, context=context):
-            for participation in seance.contact_ids:
-                workflow.trg_validate(uid, 'training.participation.stakeholder', participation.id, 'signal_done', cr)
-            for session in seance.session_ids:
-                workflow.trg_validate(uid, 'training.session', session.id, 'signal_close', cr)
+        for participation_id in contact_ids:
+            workflow.trg_validate(uid, 'training.participation.stakeholder', participation_id, 'signal_done', cr)
+        _signal_sessions(cr, uid, session_ids, 'signal_close')
 
         return True
 
     # training.seance
+    @instrumented
+    def advance_states(self, cr, uid, now=None, chunk_size=None, time_budget=None, context=None):
+        '''
+        Move the seances whose dates are reached to their next state by
+        chunks, meant to be run by a cron.
+        '''
+        if chunk_size is None:
+            chunk_size = int(CONFIG.get('training_scheduler_chunk_size', 500))
+        if time_budget is None:
+            time_budget = float(CONFIG.get('training_scheduler_time_budget', 600))
+        now = _to_datetime(now or datetime.now())
+        deadline = time.time() + time_budget
+        workflow = netsvc.LocalService('workflow')
+
+        transitions = [
+            ('confirmed', 'inprogress', 'signal_inprogress', ''),
+            ('inprogress', 'closed', 'signal_close', ''),
+            ('closed', 'done', 'signal_done', "AND presence_form = 'yes' "),
+            ]
+        res = dict((x[1], 0) for x in transitions)
+        res['complete'] = True
+
+        for state, target, signal, condition in transitions:
+            last_id = 0
+            while True:
+                if time.time() > deadline:
+                    res['complete'] = False
+                    return res
+                cr.execute("SELECT id, date, duration FROM training_seance "
+                           "WHERE state = %s "
+                           "AND date <= %s "
+                           + condition +
+                           "AND id > %s "
+                           "ORDER BY id LIMIT %s", (state, now, last_id, chunk_size))
+                rows = cr.fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                if state == 'inprogress':
+                    rows = [x for x in rows
+                            if _to_datetime(x[1]) + timedelta(hours=x[2] or 0) <= now]
+
+                with _defer_session_signals(cr, uid):
+                    for seance_id, seance_date, duration in rows:
+                        cr.execute("SAVEPOINT training_advance_state")
+                        try:
+                            workflow.trg_validate(uid, 'training.seance', seance_id, signal, cr)
+                        except Exception:
+                            cr.execute("ROLLBACK TO SAVEPOINT training_advance_state")
+                            logging.getLogger('trytond.modules.training').exception(
+                                'Seance %s could not move to %s', seance_id, target)
+                            continue
+                        cr.execute("RELEASE SAVEPOINT training_advance_state")
+                        res[target] += 1
+                # Each chunk is committed on its own, the next run continues
+                # the work left when the time budget runs out
+                cr.commit()
+
+        return res
+
+    # training.seance
+    def check_workflow_cancel(self, cr, uid, ids, context=None):
+        '''
+        Return the seances ids without any cancelled or in progress session as
+        [(seance id, None, reason)].
+        '''
+        if not ids:
+            return []
+
+        cr.execute("SELECT s.id, NULL, 'no_session_cancelled' "
+                   "FROM training_seance s "
+                   "WHERE s.id IN (" + ",".join(['%s'] * len(ids)) + ") "
+                   "AND NOT EXISTS (SELECT 1 "
+                   "FROM training_session_seance_rel rel, training_session ss "
+                   "WHERE rel.seance_id = s.id "
+                   "AND ss.id = rel.session_id "
+                   "AND ss.state IN ('cancelled', 'inprogress'))", ids)
+        return cr.fetchall()
+
+    # training.seance
+    @instrumented
     def test_workflow_cancel(self, cr, uid, ids, context=None):
-        can_be_cancelled = any(session.state in ('cancelled', 'inprogress') for seance in self.browse(cr, uid, ids, context)
-                               for session in seance.session_ids)
+        # The seances can be cancelled when one of them has a session
+        # cancelled or in progress
+        can_be_cancelled = len(self.check_workflow_cancel(cr, uid, ids, context=context)) < len(set(ids))
         return can_be_cancelled
 
     # training.seance
+    @instrumented
     def action_workflow_cancel(self, cr, uid, ids, context=None):
         workflow = netsvc.LocalService('workflow')
 
@@ -1240,10 +3346,330 @@ class TrainingSeanse(ModelView, ModelSQL):
             for session in seance.session_ids:
                 workflow.trg_validate(uid, 'training.session', session.id, 'signal_close', cr)
 
-        self.pool.get('training.participation').unlink(cr, uid, part_ids, context=context)
+        # The seats of a cancelled seance must not be given to the waiting list
+        unlink_ctx = dict(context or {}, no_waitlist_promotion=True)
+        self.pool.get('training.participation').unlink(cr, uid, part_ids, context=unlink_ctx)
 
         return self.write(cr, uid, ids, {'state' : 'cancelled'}, context=context)
 
+    # training.seance
+    @instrumented
+    def find_lecturer_conflicts(self, cr, uid, date_from, date_to, job_ids=None, context=None):
+        '''
+        Return the seances booked by the same lecturer overlapping between
+        date_from and date_to as [(job id, seance id, seance id)].
+        '''
+        cr.execute("SELECT MAX(duration) FROM training_seance WHERE state != 'cancelled'")
+        max_duration = cr.fetchone()[0] or 0
+
+        query = ("SELECT DISTINCT sh.job_id, s.id, s.date, s.duration "
+                 "FROM training_participation_stakeholder sh, training_seance s "
+                 "WHERE sh.seance_id = s.id "
+                 "AND sh.state NOT IN ('cancelled', 'refused') "
+                 "AND s.state != 'cancelled' "
+                 "AND (s.forced_lecturer IS NULL OR NOT s.forced_lecturer) "
+                 "AND sh.job_id IS NOT NULL "
+                 "AND s.date >= %s AND s.date < %s ")
+        args = [date_from - timedelta(hours=max_duration), date_to]
+        if job_ids:
+            query += "AND sh.job_id IN (" + ",".join(['%s'] * len(job_ids)) + ")"
+            args += job_ids
+        cr.execute(query, args)
+
+        intervals = {}
+        for job_id, seance_id, date, duration in cr.fetchall():
+            start = _to_datetime(date)
+            end = start + timedelta(hours=duration or 0)
+            if end > date_from:
+                intervals.setdefault(job_id, []).append((start, end, seance_id))
+
+        res = []
+        for job_id, values in intervals.items():
+            res.extend((job_id, a, b) for a, b in _overlaps(values))
+        return res
+
+    # training.seance
+    def ical_feed(self, cr, uid, kind, res_id, since=None, context=None):
+        '''
+        Return the sync token and a generator of the iCalendar lines of the
+        seances of a lecturer, a participant or a session changed since since.
+        '''
+        if kind == 'lecturer':
+            where = ("s.id IN (SELECT seance_id FROM training_participation_stakeholder "
+                     "WHERE job_id = %s AND state NOT IN ('cancelled', 'refused'))")
+            # The stakeholders keep their rows when they leave the seance
+            changes = ("SELECT seance_id, COALESCE(write_date, create_date) AS modified "
+                       "FROM training_participation_stakeholder WHERE job_id = %s")
+            deleted_key = 'job_ids'
+        elif kind == 'participant':
+            where = ("s.id IN (SELECT tp.seance_id "
+                     "FROM training_participation tp, training_subscription_line tsl "
+                     "WHERE tsl.id = tp.subscription_line_id AND tsl.contact_id = %s)")
+            changes = ("SELECT tp.seance_id, tp.create_date AS modified "
+                       "FROM training_participation tp, training_subscription_line tsl "
+                       "WHERE tsl.id = tp.subscription_line_id AND tsl.contact_id = %s")
+            deleted_key = 'contact_ids'
+        elif kind == 'session':
+            where = ("s.id IN (SELECT seance_id FROM training_session_seance_rel "
+                     "WHERE session_id = %s)")
+            changes = None
+            deleted_key = 'session_ids'
+        else:
+            raise ValueError('Unknown calendar kind %r' % kind)
+
+        cr.execute("SELECT MAX(COALESCE(s.write_date, s.create_date)) "
+                   "FROM training_seance s WHERE " + where, (res_id,))
+        marks = [cr.fetchone()[0]]
+        if changes:
+            cr.execute("SELECT MAX(x.modified) FROM (" + changes + ") x", (res_id,))
+            marks.append(cr.fetchone()[0])
+        cr.execute("SELECT MAX(create_date) FROM training_event "
+                   "WHERE (model = 'training.participation' AND event = 'delete') "
+                   "OR (model = 'training.seance' AND event = 'delete') "
+                   "OR (model = 'training.session' AND event IN ('seance_added', 'seance_removed'))")
+        marks.append(cr.fetchone()[0])
+        marks = [_to_datetime(x) for x in marks if x]
+        token = marks and max(marks).strftime('%Y-%m-%d %H:%M:%S') or None
+
+        # The seances which may have entered or left the calendar
+        candidates = set()
+        deleted = {}
+        if since:
+            since = _to_datetime(since)
+            if changes:
+                cr.execute("SELECT x.seance_id FROM (" + changes + ") x "
+                           "WHERE x.modified > %s", (res_id, since))
+                candidates.update(x[0] for x in cr.fetchall())
+            cr.execute("SELECT model, res_id, event, payload FROM training_event "
+                       "WHERE create_date > %s "
+                       "AND ((model = 'training.participation' AND event = 'delete') "
+                       "OR (model = 'training.seance' AND event = 'delete') "
+                       "OR (model = 'training.session' AND event IN ('seance_added', 'seance_removed') "
+                       "AND res_id = %s)) "
+                       "ORDER BY id", (since, kind == 'session' and res_id or 0))
+            events = [(model, event_res_id, event, json.loads(payload or '{}'))
+                      for model, event_res_id, event, payload in cr.fetchall()]
+            line_ids = set()
+            if kind == 'participant':
+                cr.execute("SELECT id FROM training_subscription_line WHERE contact_id = %s", (res_id,))
+                line_ids = set(x[0] for x in cr.fetchall())
+            for model, event_res_id, event, payload in events:
+                if model == 'training.seance':
+                    if res_id in payload.get(deleted_key, []):
+                        deleted[event_res_id] = payload
+                elif model == 'training.session':
+                    candidates.add(payload['seance_id'])
+                elif payload.get('subscription_line_id') in line_ids:
+                    candidates.add(payload['seance_id'])
+
+        columns = ("SELECT s.id, s.name, s.date, s.duration, s.state, "
+                   "COALESCE(s.write_date, s.create_date) FROM training_seance s ")
+        query = columns + "WHERE " + where
+        args = [res_id]
+        if since:
+            query += " AND (COALESCE(s.write_date, s.create_date) > %s"
+            args.append(since)
+            if candidates:
+                query += " OR s.id IN (" + ",".join(['%s'] * len(candidates)) + ")"
+                args.extend(sorted(candidates))
+            query += ")"
+        query += " ORDER BY s.date"
+
+        def event_lines(seance_id, name, date, duration, status, modified):
+            start = _to_datetime(date)
+            end = start + timedelta(hours=duration or 0)
+            yield 'BEGIN:VEVENT\r\n'
+            yield 'UID:training-seance-%d@tryton\r\n' % seance_id
+            yield 'DTSTAMP:%s\r\n' % _ical_datetime(modified)
+            yield 'DTSTART:%s\r\n' % _ical_datetime(start)
+            yield 'DTEND:%s\r\n' % _ical_datetime(end)
+            yield 'SUMMARY:%s\r\n' % _ical_escape(name)
+            yield 'STATUS:%s\r\n' % status
+            yield 'END:VEVENT\r\n'
+
+        def lines():
+            yield 'BEGIN:VCALENDAR\r\n'
+            yield 'VERSION:2.0\r\n'
+            yield 'PRODID:-//Tryton//Training//EN\r\n'
+            sent = set()
+            cr.execute(query, args)
+            while True:
+                rows = cr.fetchmany(500)
+                if not rows:
+                    break
+                for seance_id, name, date, duration, state, modified in rows:
+                    sent.add(seance_id)
+                    if state == 'cancelled':
+                        status = 'CANCELLED'
+                    elif state == 'opened':
+                        status = 'TENTATIVE'
+                    else:
+                        status = 'CONFIRMED'
+                    for line in event_lines(seance_id, name, date, duration, status, modified):
+                        yield line
+
+            # The seances which left the calendar are cancelled for it
+            removed = sorted(candidates - sent)
+            if removed:
+                cr.execute(columns + "WHERE s.id IN (" + ",".join(['%s'] * len(removed)) + ") "
+                           "AND NOT " + where, removed + [res_id])
+                for seance_id, name, date, duration, state, modified in cr.fetchall():
+                    for line in event_lines(seance_id, name, date, duration, 'CANCELLED', token):
+                        yield line
+            for seance_id, payload in sorted(deleted.items()):
+                for line in event_lines(seance_id, payload['name'], payload['date'],
+                                        payload['duration'], 'CANCELLED', token):
+                    yield line
+            yield 'END:VCALENDAR\r\n'
+
+        # The lines are read from cr, the caller must not use it until the
+        # feed is consumed
+        return token, lines()
+
+    # training.seance
+    @instrumented
+    def plan_resources(self, cr, uid, ids, write=True, context=None):
+        '''
+        Assign the smallest fitting free room to the seances ids, return the
+        'assignment' and the 'unassigned' seances.
+        '''
+        res = {'assignment' : {}, 'unassigned' : []}
+        if not ids:
+            return res
+
+        cr.execute("SELECT id, date, duration, max_limit, manual, participant_count_manual "
+                   "FROM training_seance "
+                   "WHERE state != 'cancelled' "
+                   "AND id IN (" + ",".join(['%s'] * len(ids)) + ")", ids)
+        rows = cr.fetchall()
+        if not rows:
+            return res
+        counts = self._participant_count(cr, uid, [x[0] for x in rows], None, None, context=context)
+
+        seances = []
+        for seance_id, date, duration, max_limit, manual, count_manual in rows:
+            start = _to_datetime(date)
+            end = start + timedelta(hours=duration or 0)
+            count = manual and count_manual or counts[seance_id]
+            seances.append((start, end, seance_id, max(max_limit or 0, count or 0)))
+        seances.sort()
+        date_from = seances[0][0]
+        date_to = max(x[1] for x in seances)
+
+        cr.execute("SELECT id, capacity FROM training_resource "
+                   "WHERE kind = 'room' AND active "
+                   "ORDER BY capacity, id")
+        free = [(capacity or 0, room_id) for room_id, capacity in cr.fetchall()]
+
+        # Bookings of the seances which are not planned here
+        cr.execute("SELECT MAX(duration) FROM training_seance WHERE state != 'cancelled'")
+        max_duration = cr.fetchone()[0] or 0
+        cr.execute("SELECT resource_id, date, duration FROM training_seance "
+                   "WHERE resource_id IS NOT NULL "
+                   "AND state != 'cancelled' "
+                   "AND date >= %s AND date < %s "
+                   "AND id NOT IN (" + ",".join(['%s'] * len(ids)) + ")",
+                   [date_from - timedelta(hours=max_duration), date_to] + list(ids))
+        booked = {}
+        for room_id, date, duration in cr.fetchall():
+            start = _to_datetime(date)
+            booked.setdefault(room_id, []).append((start, start + timedelta(hours=duration or 0)))
+
+        def is_booked(room_id, start, end):
+            return any(s < end and start < e for s, e in booked.get(room_id, ()))
+
+        busy = []
+        for start, end, seance_id, seats in seances:
+            while busy and busy[0][0] <= start:
+                end_, capacity, room_id = heapq.heappop(busy)
+                bisect.insort(free, (capacity, room_id))
+
+            index = bisect.bisect_left(free, (seats, 0))
+            while index < len(free) and is_booked(free[index][1], start, end):
+                index += 1
+            if index == len(free):
+                res['unassigned'].append(seance_id)
+                continue
+
+            capacity, room_id = free.pop(index)
+            heapq.heappush(busy, (end, capacity, room_id))
+            res['assignment'][seance_id] = room_id
+
+        if write:
+            by_room = {}
+            for seance_id, room_id in res['assignment'].items():
+                by_room.setdefault(room_id, []).append(seance_id)
+            for room_id, seance_ids in by_room.items():
+                self.write(cr, uid, seance_ids, {'resource_id' : room_id}, context=context)
+
+        return res
+
+    # training.seance
+    def _lock(self, cr, ids):
+        # Rows are always locked in the same order to avoid deadlocks between
+        # concurrent reservations, SQLite serializes the writers by itself
+        if ids and backend.name() == 'postgresql':
+            cr.execute("SELECT id FROM training_seance "
+                       "WHERE id IN (" + ",".join(['%s'] * len(ids)) + ") "
+                       "ORDER BY id FOR UPDATE", sorted(ids))
+
+    # training.seance
+    def _free_seats(self, cr, uid, ids, context=None):
+        # The seats are held by every participation which is not cancelled,
+        # the value is None for the seances without maximum threshold or in
+        # manual mode as they are never full
+        res = {}
+        if not ids:
+            return res
+
+        cr.execute(_counting_query('training.seance.free_seats', ids), ids)
+
+        for seance_id, max_limit, manual, count in cr.fetchall():
+            if manual or max_limit <= 0:
+                res[seance_id] = None
+            else:
+                res[seance_id] = max(max_limit - int(count), 0)
+        return res
+
+    # training.seance
+    def _full_seances(self, cr, uid, ids, context=None):
+        return [seance_id for seance_id, free in self._free_seats(cr, uid, ids, context=context).items()
+                if free == 0]
+
+    # training.seance
+    @instrumented
+    def reserve_seats(self, cr, uid, ids, subscription_line, context=None):
+        '''
+        Reserve under lock a seat on the seances ids and on the session of
+        subscription_line, return the status and the participations.
+        '''
+        proxy_session = self.pool.get('training.session')
+        session_id = subscription_line.session_id.id
+        proxy_session._lock(cr, [session_id])
+        self._lock(cr, ids)
+
+        full_seance_ids = self._full_seances(cr, uid, ids, context=context)
+        full_session_ids = [x for x, free in proxy_session._free_seats(
+            cr, uid, [session_id], [subscription_line.id], context=context).items() if free == 0]
+        if full_seance_ids or full_session_ids:
+            return {
+                'status' : 'full',
+                'seance_ids' : ids,
+                'participation_ids' : [],
+                'full_seance_ids' : full_seance_ids,
+                'full_session_ids' : full_session_ids,
+            }
+
+        participation_ids = [self._create_participation(cr, uid, seance, subscription_line, context=context)
+                             for seance in self.browse(cr, uid, ids, context=context)]
+        return {
+            'status' : 'reserved',
+            'seance_ids' : ids,
+            'participation_ids' : participation_ids,
+            'full_seance_ids' : [],
+            'full_session_ids' : [],
+        }
+
     # training.seance
     def _create_participation(self, cr, uid, seance, subscription_line, context=None):
         proxy = self.pool.get('training.participation')
@@ -1269,21 +3695,79 @@ class TrainingSeanse(ModelView, ModelSQL):
         return {}
 
     # training.seance
+    @instrumented
     def create_procurements(self, cr, uid, ids, context=None):
         purchase_order_pool = self.pool.get('purchase.order')
-        location_id = self.pool.get('stock.location').search(cr, uid, [('usage', '=', 'internal')], context=context)[0]
+        proxy = self.pool.get('training.seance.purchase_line')
+        if not ids:
+            return True
+
+        cr.execute("SELECT id, participant_count_manual "
+                   "FROM training_seance "
+                   "WHERE manual "
+                   "AND id IN (" + ",".join(['%s'] * len(ids)) + ")", ids)
+        counts = dict(cr.fetchall())
+        if not counts:
+            return True
+
+        location_id = _get_internal_location(self.pool, cr, uid, context=context)
+
+        # The lines of all the seances are read in one pass, the purchase
+        # orders are still created by line as create_from_procurement_line
+        # links each one to its procurement
+        line_ids = proxy.search(cr, uid, [('seance_id', 'in', list(counts))], context=context)
+        for po_line in proxy.browse(cr, uid, line_ids, context=context):
+            quantity = po_line.product_qty
+            if po_line.fix == 'by_subscription':
+                quantity = quantity * (counts[po_line.seance_id.id] or 0)
+
+            purchase_order_pool.create_from_procurement_line(cr, uid, po_line, quantity, location_id, context=context)
 
-        for seance in self.browse(cr, uid, ids, context=context):
-            if seance.manual:
-                for po_line in seance.purchase_line_ids:
-                    quantity = po_line.product_qty
-                    if po_line.fix == 'by_subscription':
-                        quantity = quantity * seance.participant_count_manual
+        return True
 
-                    procurement_id = purchase_order_pool.create_from_procurement_line(cr, uid, po_line, quantity, location_id, context=context)
+    @instrumented
+    def create(self, cr, uid, vals, context=None):
+        seance_id = super(TrainingSeanse, self).create(cr, uid, vals, context=context)
+        _update_seance_chains(cr, [seance_id])
+        return seance_id
+
+    @instrumented
+    def write(self, cr, uid, ids, vals, context=None):
+        _invalidate_prefetched(cr)
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        old_states = 'state' in vals and _read_states(cr, 'training_seance', ids) or {}
+        old_pairs = 'session_ids' in vals and _session_seance_pairs(cr, 'seance_id', ids) or set()
+        res = super(TrainingSeanse, self).write(cr, uid, ids, vals, context=context)
+        if 'session_ids' in vals:
+            _append_link_events(cr, uid, old_pairs, _session_seance_pairs(cr, 'seance_id', ids))
+        if any(f in vals for f in SEATS_FIELDS):
+            _invalidate_available_seats()
+        if 'master_id' in vals or 'date' in vals:
+            _update_seance_chains(cr, ids)
+        if 'state' in vals:
+            _append_state_events(cr, uid, self._name, old_states, vals['state'])
+        return res
 
-        return True
+    # training.seance
+    def get_chain(self, cr, uid, ids, context=None):
+        '''
+        Return the seances of the split course of each seance of ids in chain
+        order as {seance id: [seance ids]}.
+        '''
+        res = dict((x, []) for x in ids)
+        if not ids:
+            return res
+        cr.execute("SELECT s.id, c.id "
+                   "FROM training_seance s, training_seance c "
+                   "WHERE c.chain_id = s.chain_id "
+                   "AND s.id IN (" + ",".join(['%s'] * len(ids)) + ") "
+                   "ORDER BY s.id, c.chain_position, c.id", ids)
+        for seance_id, chain_seance_id in cr.fetchall():
+            res[seance_id].append(chain_seance_id)
+        return res
 
+    @instrumented
     def unlink(self, cr, uid, ids, context=None):
         for seance in self.browse(cr, uid, ids, context=context):
             if seance.state == 'confirmed':
@@ -1297,7 +3781,48 @@ class TrainingSeanse(ModelView, ModelSQL):
                         raise osv.except_osv(_('Warning'),
                                              _("You can not suppress a seance with a invoiced subscription"))
 
-        return super(training_seance, self).unlink(cr, uid, ids, context=context)
+        _invalidate_prefetched(cr)
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        deleted = self._deleted_payloads(cr, ids)
+        res = super(training_seance, self).unlink(cr, uid, ids, context=context)
+        _invalidate_available_seats()
+        _append_events(cr, uid, self._name, 'delete', sorted(deleted.items()))
+        return res
+
+    # training.seance
+    def _deleted_payloads(self, cr, ids):
+        # What the calendars need to remove a deleted seance, its
+        # participations and stakeholders being deleted with it
+        if not ids:
+            return {}
+        in_ids = ",".join(['%s'] * len(ids))
+        cr.execute("SELECT id, name, date, duration FROM training_seance "
+                   "WHERE id IN (" + in_ids + ")", ids)
+        res = {}
+        for seance_id, name, seance_date, duration in cr.fetchall():
+            res[seance_id] = {
+                'name' : name,
+                'date' : _to_datetime(seance_date).strftime('%Y-%m-%d %H:%M:%S'),
+                'duration' : duration,
+                'session_ids' : [],
+                'job_ids' : [],
+                'contact_ids' : [],
+            }
+        for key, query in (
+                ('session_ids', "SELECT seance_id, session_id FROM training_session_seance_rel "
+                 "WHERE seance_id IN (" + in_ids + ")"),
+                ('job_ids', "SELECT seance_id, job_id FROM training_participation_stakeholder "
+                 "WHERE seance_id IN (" + in_ids + ")"),
+                ('contact_ids', "SELECT tp.seance_id, tsl.contact_id "
+                 "FROM training_participation tp, training_subscription_line tsl "
+                 "WHERE tsl.id = tp.subscription_line_id "
+                 "AND tp.seance_id IN (" + in_ids + ")")):
+            cr.execute(query, ids)
+            for seance_id, value in cr.fetchall():
+                if value and value not in res[seance_id][key]:
+                    res[seance_id][key].append(value)
+        return res
 
     def copy(self, cr, uid, object_id, values, context=None):
         if not 'is_first_seance' in values:
@@ -1305,6 +3830,7 @@ class TrainingSeanse(ModelView, ModelSQL):
 
         return super(training_seance, self).copy(cr, uid, object_id, values, context=context)
 
+    @instrumented
     def search(self, cr, uid, domain, offset=0, limit=None, order=None, context=None, count=False):
         offer_id = context and context.get('offer_id', False) or False
 
@@ -1327,20 +3853,16 @@ class TrainingSeanse(ModelView, ModelSQL):
         request_session_id = context and context.get('request_session_id', False) or False
 
         if job_id and request_session_id:
-            session = self.pool.get('training.session').browse(cr, uid, request_session_id, context=context)
-            course_proxy = self.pool.get('training.course')
-            seance_ids = []
-            for seance in session.seance_ids:
-                if seance.course_id and job_id:
-                    cr.execute('select course_id from training_course_job_rel where course_id = %s and job_id = %s',
-                               (seance.course_id.id, job_id,)
-                              )
-
-                    res = [x[0] for x in cr.fetchall()]
-                    if res:
-                        seance_ids.append(seance.id)
+            cr.execute("SELECT s.id "
+                       "FROM training_session_seance_rel rel, training_seance s, training_course_job_rel cj "
+                       "WHERE s.id = rel.seance_id "
+                       "AND cj.course_id = s.course_id "
+                       "AND rel.session_id = %s "
+                       "AND cj.job_id = %s "
+                       "ORDER BY s.date, s.id",
+                       (request_session_id, job_id))
 
-            return seance_ids
+            return [x[0] for x in cr.fetchall()]
 
 
         return super(TrainingSeanse, self).search(cr, uid, domain, offset=offset,
@@ -1349,4 +3871,608 @@ class TrainingSeanse(ModelView, ModelSQL):
     def _get_product(self, cr, uid, ids, context=None):
         assert len(ids) == 1
         seance = self.browse(cr, uid, ids[0], context)
-        return seance.course_id.course_type_id.product_id
\ No newline at end of file
+        return seance.course_id.course_type_id.product_id
+
+class TrainingResource(ModelView, ModelSQL):
+    'Resource'
+    __name__ = 'training.resource'
+
+    name = fields.Char('Name', required=True)
+    kind = fields.Selection([('room', 'Room'),
+                             ('equipment', 'Equipment')],
+                            'Kind', required=True)
+    capacity = fields.Integer('Capacity', required=True,
+                              help="The number of seats of the room or the quantity of equipment")
+    active = fields.Boolean('Active')
+    seances = fields.One2Many('training.seance', 'resource_id', 'Seances', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(TrainingResource, cls).__setup__()
+        cls._sql_constraints += [
+            ('check_capacity', 'CHECK(capacity >= 0)', 'The capacity must be positive.'),
+            ]
+
+    @staticmethod
+    def default_kind():
+        return 'room'
+
+    @staticmethod
+    def default_capacity():
+        return 0
+
+    @staticmethod
+    def default_active():
+        return True
+
+
+class TrainingWaitlist(ModelView, ModelSQL):
+    'Waiting List'
+    __name__ = 'training.waitlist'
+
+    session = fields.Many2One('training.session', 'Session', required=True, ondelete='CASCADE')
+    seance = fields.Many2One('training.seance', 'Seance', ondelete='CASCADE',
+                             help="Wait for a seat on this seance only")
+    subscription_line = fields.Many2One('training.subscription.line', 'Subscription Line',
+                                        required=True, ondelete='CASCADE')
+    priority = fields.Integer('Priority', required=True,
+                              help="The waiters with the highest priority are promoted first")
+    date = fields.DateTime('Date', required=True, readonly=True)
+    state = fields.Selection([('waiting', 'Waiting'),
+                              ('promoted', 'Promoted'),
+                              ('cancelled', 'Cancelled')],
+                             'State', required=True, readonly=True)
+    notified = fields.Boolean('Notified', readonly=True,
+                              help="The promotion has been notified to the participant")
+
+    @classmethod
+    def __setup__(cls):
+        super(TrainingWaitlist, cls).__setup__()
+        cls._order.insert(0, ('priority', 'DESC'))
+        cls._order.insert(1, ('date', 'ASC'))
+        cls._sql_constraints += [
+            ('uniq_subscription_line', 'UNIQUE(subscription_line)', 'The subscription line is already on the waiting list.'),
+            ]
+
+    @staticmethod
+    def default_priority():
+        return 0
+
+    @staticmethod
+    def default_date():
+        return datetime.now()
+
+    @staticmethod
+    def default_state():
+        return 'waiting'
+
+    @staticmethod
+    def default_notified():
+        return False
+
+    # training.waitlist
+    def get_position(self, cr, uid, waiter_id, context=None):
+        cr.execute('SELECT COUNT(o.id) '
+                   'FROM training_waitlist w, training_waitlist o '
+                   'WHERE w.id = %s '
+                   'AND o."session" = w."session" '
+                   'AND o.state = %s '
+                   'AND (o.priority > w.priority '
+                   'OR (o.priority = w.priority AND (o.date < w.date '
+                   'OR (o.date = w.date AND o.id <= w.id))))',
+                   (waiter_id, 'waiting'))
+        return int(cr.fetchone()[0])
+
+    # training.waitlist
+    def add_waiter(self, cr, uid, subscription_line, seance_id=None, priority=0, context=None):
+        '''
+        Put subscription_line on the waiting list of its session and return its
+        position.
+        '''
+        waiters = self.read(cr, uid, self.search(cr, uid, [('subscription_line', '=', subscription_line.id)],
+                                                 context=context), ['state'], context=context)
+        if waiters:
+            waiter_id = waiters[0]['id']
+            if waiters[0]['state'] != 'waiting':
+                self.write(cr, uid, [waiter_id], {
+                    'session' : subscription_line.session_id.id,
+                    'seance' : seance_id,
+                    'priority' : priority,
+                    'date' : datetime.now(),
+                    'state' : 'waiting',
+                    'notified' : False,
+                }, context=context)
+        else:
+            waiter_id = self.create(cr, uid, {
+                'session' : subscription_line.session_id.id,
+                'seance' : seance_id,
+                'subscription_line' : subscription_line.id,
+                'priority' : priority,
+            }, context=context)
+
+        return self.get_position(cr, uid, waiter_id, context=context)
+
+    # training.waitlist
+    def cancel_waiters(self, cr, uid, session_ids, context=None):
+        waiter_ids = self.search(cr, uid, [('session', 'in', session_ids),
+                                           ('state', '=', 'waiting')], context=context)
+        if waiter_ids:
+            self.write(cr, uid, waiter_ids, {'state' : 'cancelled'}, context=context)
+        return waiter_ids
+
+    # training.waitlist
+    def cancel_lines(self, cr, uid, line_ids, context=None):
+        waiter_ids = self.search(cr, uid, [('subscription_line', 'in', line_ids),
+                                           ('state', '=', 'waiting')], context=context)
+        if waiter_ids:
+            self.write(cr, uid, waiter_ids, {'state' : 'cancelled'}, context=context)
+        return waiter_ids
+
+    # training.waitlist
+    def promote(self, cr, uid, session_ids, context=None):
+        '''
+        Give the free seats of session_ids to the next waiters and return their
+        ids.
+        '''
+        if not session_ids:
+            return []
+
+        cr.execute('SELECT w.id, w."session", w.seance, w.subscription_line '
+                   'FROM training_waitlist w, training_session s '
+                   'WHERE s.id = w."session" '
+                   'AND w.state = %s '
+                   "AND s.state IN ('opened', 'opened_confirmed') "
+                   'AND w."session" IN (' + ','.join(['%s'] * len(session_ids)) + ') '
+                   'ORDER BY w.priority DESC, w.date ASC, w.id ASC',
+                   ['waiting'] + list(session_ids))
+        waiters = cr.fetchall()
+        if not waiters:
+            return []
+
+        waiting_session_ids = list(set(x[1] for x in waiters))
+        cr.execute("SELECT session_id, seance_id "
+                   "FROM training_session_seance_rel "
+                   "WHERE session_id IN (" + ",".join(['%s'] * len(waiting_session_ids)) + ")",
+                   waiting_session_ids)
+        session_seances = {}
+        for session_id, seance_id in cr.fetchall():
+            session_seances.setdefault(session_id, []).append(seance_id)
+
+        seance_proxy = self.pool.get('training.seance')
+        session_proxy = self.pool.get('training.session')
+        line_proxy = self.pool.get('training.subscription.line')
+        free = seance_proxy._free_seats(cr, uid,
+                                        list(set(x for v in session_seances.values() for x in v)),
+                                        context=context)
+
+        promoted_ids = []
+        full_session_ids = set()
+        for waiter_id, session_id, seance_id, line_id in waiters:
+            seance_ids = seance_id and [seance_id] or session_seances.get(session_id, [])
+            if session_id in full_session_ids or not any(free.get(x) != 0 for x in seance_ids):
+                continue
+
+            line = line_proxy.browse(cr, uid, line_id, context=context)
+            if seance_id:
+                result = seance_proxy.reserve_seats(cr, uid, [seance_id], line, context=context)
+            else:
+                result = session_proxy._create_participation(cr, uid, [session_id], line,
+                                                             waitlist=False, context=context)
+
+            if result['status'] == 'reserved':
+                promoted_ids.append(waiter_id)
+                for x in result['seance_ids']:
+                    if free.get(x):
+                        free[x] -= 1
+            else:
+                for x in result['full_seance_ids']:
+                    free[x] = 0
+                full_session_ids.update(result['full_session_ids'])
+
+        if promoted_ids:
+            self.write(cr, uid, promoted_ids, {'state' : 'promoted', 'notified' : False}, context=context)
+        return promoted_ids
+
+    # training.waitlist
+    def send_notifications(self, cr, uid, context=None):
+        '''
+        Send the queued promotion notifications, meant to be run by a cron
+        '''
+        waiter_ids = self.search(cr, uid, [('state', '=', 'promoted'),
+                                           ('notified', '=', False)], context=context)
+        if waiter_ids:
+            line_ids = [waiter.subscription_line.id for waiter in self.browse(cr, uid, waiter_ids, context=context)]
+            self.pool.get('training.subscription.line').send_email(cr, uid, line_ids, 'waitlist_promoted', context)
+            self.write(cr, uid, waiter_ids, {'notified' : True}, context=context)
+        return True
+
+
+class TrainingRecomputeQueue(ModelSQL):
+    'Recompute Queue'
+    __name__ = 'training.recompute.queue'
+
+    model = fields.Char('Model', required=True, select=True)
+    field = fields.Char('Field', required=True)
+    res_id = fields.Integer('Resource ID', required=True)
+
+    # training.recompute.queue
+    def process(self, cr, uid, limit=10000, context=None):
+        '''
+        Recompute the queued fields once by record, meant to be run by a cron.
+        Return the number of processed entries.
+        '''
+        query = ("SELECT id, model, field, res_id "
+                 "FROM training_recompute_queue "
+                 "ORDER BY id LIMIT %s")
+        if backend.name() == 'postgresql':
+            query += " FOR UPDATE SKIP LOCKED"
+        cr.execute(query, (limit,))
+        rows = cr.fetchall()
+        if not rows:
+            return 0
+
+        pending = {}
+        for queue_id, model, field, res_id in rows:
+            pending.setdefault((model, field), set()).add(res_id)
+        self._recompute(cr, uid, pending, context=context)
+
+        queue_ids = [x[0] for x in rows]
+        cr.execute("DELETE FROM training_recompute_queue "
+                   "WHERE id IN (" + ",".join(['%s'] * len(queue_ids)) + ")", queue_ids)
+        return len(rows)
+
+    # training.recompute.queue
+    def process_dirty(self, cr, uid, context=None):
+        '''
+        Recompute the fields marked by the transaction of cr, run when it
+        commits. Return the number of recomputed records.
+        '''
+        dirty = _dirty.get(_real_cursor(cr))
+        if not dirty:
+            return 0
+
+        pending = {}
+        for model, field, res_id in dirty:
+            pending.setdefault((model, field), set()).add(res_id)
+        self._recompute(cr, uid, pending, context=context)
+        return len(_dirty.pop(_real_cursor(cr)))
+
+    # training.recompute.queue
+    def enqueue(self, cr, uid, dirty, context=None):
+        # The records left to the cron
+        if not dirty:
+            return
+        now = datetime.now()
+        _bulk_insert(cr, 'training_recompute_queue', ['model', 'field', 'res_id', 'create_uid', 'create_date'],
+                     [[model, field, res_id, uid, now] for model, field, res_id in sorted(dirty)],
+                     returning=False)
+
+    # training.recompute.queue
+    def _recompute(self, cr, uid, pending, context=None):
+        for (model, field), res_ids in pending.items():
+            table, method = RECOMPUTED_FIELDS[(model, field)]
+            obj = self.pool.get(model)
+            cr.execute('SELECT id FROM "' + table + '" '
+                       'WHERE id IN (' + ','.join(['%s'] * len(res_ids)) + ')', list(res_ids))
+            ids = [x[0] for x in cr.fetchall()]
+            if not ids:
+                continue
+
+            by_value = {}
+            for res_id, value in getattr(obj, method)(cr, uid, ids, [field], None, context=context).items():
+                by_value.setdefault(value, []).append(res_id)
+            for value, value_ids in by_value.items():
+                cr.execute('UPDATE "' + table + '" SET "' + field + '" = %s '
+                           'WHERE id IN (' + ','.join(['%s'] * len(value_ids)) + ')',
+                           [value] + value_ids)
+
+
+class TrainingEvent(ModelSQL):
+    'Training Event'
+    __name__ = 'training.event'
+
+    model = fields.Char('Model', required=True)
+    res_id = fields.Integer('Resource ID', required=True)
+    event = fields.Char('Event', required=True,
+                        help="'state' for a state change, 'create', 'delete' or 'archive'")
+    payload = fields.Text('Payload', help="The JSON details of the event")
+    txid = fields.BigInteger('Transaction ID', readonly=True,
+                             help="The PostgreSQL transaction which appended the event")
+
+    @classmethod
+    def __register__(cls, module_name):
+        super(TrainingEvent, cls).__register__(module_name)
+        cursor = Transaction().cursor
+        # The events are stamped with their transaction by the database
+        if backend.name() == 'postgresql':
+            cursor.execute("UPDATE training_event SET txid = 0 WHERE txid IS NULL")
+            cursor.execute("ALTER TABLE training_event ALTER COLUMN txid SET DEFAULT txid_current()")
+        _create_indexes(cursor)
+
+    # training.event
+    def fetch_events(self, cr, uid, since_id=0, limit=1000, context=None):
+        '''
+        Return at most limit events appended after the event since_id, in an
+        order where no event can later appear before the ones returned.
+        '''
+        columns = "SELECT id, model, res_id, event, payload, create_date FROM training_event "
+        if backend.name() == 'postgresql':
+            # The ids are taken at insert, not at commit: only the events of
+            # the transactions older than every running one are returned,
+            # ordered by transaction, as no event can be added to them
+            cr.execute(columns +
+                       "WHERE (txid, id) > (COALESCE((SELECT txid FROM training_event WHERE id = %s), 0), %s) "
+                       "AND txid < txid_snapshot_xmin(txid_current_snapshot()) "
+                       "ORDER BY txid, id LIMIT %s", (since_id, since_id, limit))
+        else:
+            # SQLite serializes the writers so the ids follow the commits
+            cr.execute(columns + "WHERE id > %s ORDER BY id LIMIT %s", (since_id, limit))
+        return [{
+                'id' : event_id,
+                'model' : model,
+                'res_id' : res_id,
+                'event' : event,
+                'payload' : json.loads(payload or '{}'),
+                'date' : _to_datetime(create_date),
+            } for event_id, model, res_id, event, payload, create_date in cr.fetchall()]
+
+
+class TrainingCourseClosure(ModelSQL):
+    'Course Closure'
+    __name__ = 'training.course.closure'
+
+    ancestor = fields.Many2One('training.course', 'Ancestor', required=True,
+                               select=True, ondelete='CASCADE')
+    descendant = fields.Many2One('training.course', 'Descendant', required=True,
+                                 ondelete='CASCADE')
+    depth = fields.Integer('Depth', required=True)
+    path = fields.Char('Path', required=True,
+                       help="The position of the descendant in the depth-first traversal of the courses")
+
+    # training.course.closure
+    def rebuild(self, cr, uid, context=None):
+        '''
+        Fill the whole closure of the course hierarchy.
+        '''
+        course_ids = self.pool.get('training.course').search(cr, uid, [],
+            context=dict(context or {}, active_test=False))
+        cr.execute("DELETE FROM training_course_closure")
+        self.update(cr, uid, course_ids, context=context)
+
+    # training.course.closure
+    def subtree(self, cr, uid, course_ids, context=None):
+        # The courses of course_ids with their descendants in the closure
+        if not course_ids:
+            return set()
+        cr.execute("SELECT descendant FROM training_course_closure "
+                   "WHERE ancestor IN (" + ",".join(['%s'] * len(course_ids)) + ")", list(course_ids))
+        return set(course_ids).union(x[0] for x in cr.fetchall())
+
+    # training.course.closure
+    def update(self, cr, uid, course_ids, context=None):
+        '''
+        Replace the closure rows of the subtrees of the created, written or
+        deleted course_ids.
+        '''
+        if not course_ids:
+            return
+        course_proxy = self.pool.get('training.course')
+        ctx = dict(context or {}, active_test=False)
+
+        # The courses which can move: the subtrees of course_ids and of their
+        # new children
+        existing = course_proxy.search(cr, uid, [('id', 'in', list(course_ids))], context=ctx)
+        children = set(x for values in course_proxy.read(cr, uid, existing, ['course_ids'], context=context)
+                       for x in values['course_ids'] or [])
+        moved = self.subtree(cr, uid, set(course_ids) | children, context=context)
+        cr.execute("DELETE FROM training_course_closure "
+                   "WHERE descendant IN (" + ",".join(['%s'] * len(moved)) + ")", list(moved))
+        moved = set(course_proxy.search(cr, uid, [('id', 'in', list(moved))], context=ctx))
+        if not moved:
+            return
+
+        # A course child of several courses is placed under the one with the
+        # lowest id at its position in its course_ids
+        parent_ids = course_proxy.search(cr, uid, [('course_ids', 'in', list(moved))], context=ctx)
+        parents, positions = {}, {}
+        for values in sorted(course_proxy.read(cr, uid, parent_ids, ['course_ids'], context=context),
+                             key=lambda x: x['id'], reverse=True):
+            for position, child_id in enumerate(values['course_ids'] or []):
+                if child_id in moved:
+                    parents[child_id] = values['id']
+                    positions[child_id] = position
+
+        # The cycles are broken at their lowest course
+        done = set()
+        for course_id in sorted(moved):
+            trail = []
+            current = course_id
+            while current in moved and current not in done and current not in trail:
+                trail.append(current)
+                current = parents.get(current)
+            if current in trail:
+                parents.pop(min(trail[trail.index(current):]), None)
+            done.update(trail)
+
+        # The ancestors of the courses left in place are read from their rows
+        fixed = set(parents.values()) - moved
+        ancestors = dict((x, []) for x in fixed)
+        paths = {}
+        if fixed:
+            cr.execute("SELECT descendant, ancestor, path FROM training_course_closure "
+                       "WHERE descendant IN (" + ",".join(['%s'] * len(fixed)) + ") "
+                       "ORDER BY descendant, depth DESC", list(fixed))
+            for course_id, ancestor, path in cr.fetchall():
+                ancestors[course_id].append(ancestor)
+                paths[course_id] = path
+        for course_id in fixed:
+            if course_id not in paths:
+                ancestors[course_id] = [course_id]
+                paths[course_id] = '%010d' % course_id
+
+        # The paths are made of fixed width positions so they sort like the
+        # depth-first traversal of get_list_of_courses
+        def place(course_id):
+            if course_id not in paths:
+                parent_id = parents.get(course_id)
+                if parent_id is None:
+                    ancestors[course_id] = [course_id]
+                    paths[course_id] = '%010d' % course_id
+                else:
+                    place(parent_id)
+                    ancestors[course_id] = ancestors[parent_id] + [course_id]
+                    paths[course_id] = '%s/%06d' % (paths[parent_id], positions[course_id])
+
+        rows = []
+        now = datetime.now()
+        for course_id in sorted(moved):
+            place(course_id)
+            for depth, ancestor in enumerate(reversed(ancestors[course_id])):
+                rows.append([ancestor, course_id, depth, paths[course_id], uid, now])
+
+        columns = ['ancestor', 'descendant', 'depth', 'path', 'create_uid', 'create_date']
+        for i in range(0, len(rows), 100):
+            _bulk_insert(cr, 'training_course_closure', columns, rows[i:i + 100], returning=False)
+
+    # training.course.closure
+    def get_leaf_courses(self, cr, uid, course_ids, context=None):
+        '''
+        Return the leaf courses of each course of course_ids in depth-first
+        order as {course id: [(leaf id, duration, splitted_by)]}.
+        '''
+        res = dict((x, []) for x in course_ids)
+        if not course_ids:
+            return res
+
+        cr.execute("SELECT cl.ancestor, c.id, c.duration, c.splitted_by "
+                   "FROM training_course_closure cl, training_course c "
+                   "WHERE c.id = cl.descendant "
+                   "AND cl.ancestor IN (" + ",".join(['%s'] * len(course_ids)) + ") "
+                   "AND NOT EXISTS (SELECT 1 FROM training_course_closure child "
+                   "WHERE child.ancestor = c.id AND child.depth = 1) "
+                   "ORDER BY cl.ancestor, cl.path", course_ids)
+        for course_id, leaf_id, duration, splitted_by in cr.fetchall():
+            res[course_id].append((leaf_id, duration, splitted_by))
+        return res
+
+    # training.course.closure
+    def get_offer_leaf_courses(self, cr, uid, offer_id, context=None):
+        '''
+        Return with one query the leaf courses of the offer in planning order
+        as a list of (course id, leaf id, duration, splitted_by).
+        '''
+        cr.execute("SELECT rel.course_id, c.id, c.duration, c.splitted_by "
+                   "FROM training_course_offer_rel rel, training_course_closure cl, training_course c "
+                   "WHERE cl.ancestor = rel.course_id "
+                   "AND c.id = cl.descendant "
+                   "AND rel.offer_id = %s "
+                   "AND NOT EXISTS (SELECT 1 FROM training_course_closure child "
+                   "WHERE child.ancestor = c.id AND child.depth = 1) "
+                   "ORDER BY rel.id, cl.path", (offer_id,))
+        return cr.fetchall()
+
+
+class Course:
+    __metaclass__ = PoolMeta
+    __name__ = 'training.course'
+
+    # Only the closure rows of the changed subtrees are replaced
+    def create(self, cr, uid, vals, context=None):
+        course_id = super(Course, self).create(cr, uid, vals, context=context)
+        self.pool.get('training.course.closure').update(cr, uid, [course_id], context=context)
+        return course_id
+
+    def write(self, cr, uid, ids, vals, context=None):
+        res = super(Course, self).write(cr, uid, ids, vals, context=context)
+        if 'course_ids' in vals or 'parent_id' in vals:
+            if isinstance(ids, (int, long)):
+                ids = [ids]
+            self.pool.get('training.course.closure').update(cr, uid, ids, context=context)
+        return res
+
+    def unlink(self, cr, uid, ids, context=None):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        closure = self.pool.get('training.course.closure')
+        # Read before the rows of the deleted courses cascade
+        subtree = closure.subtree(cr, uid, ids, context=context)
+        res = super(Course, self).unlink(cr, uid, ids, context=context)
+        closure.update(cr, uid, list(subtree), context=context)
+        return res
+
+
+class SubscriptionLine:
+    __metaclass__ = PoolMeta
+    __name__ = 'training.subscription.line'
+
+    def write(self, cr, uid, ids, vals, context=None):
+        res = super(SubscriptionLine, self).write(cr, uid, ids, vals, context=context)
+        # The seats are counted from the state of the lines
+        if 'state' in vals or 'session_id' in vals:
+            _invalidate_prefetched(cr)
+            _invalidate_available_seats()
+
+        # The seats freed by the cancelled lines are given to the waiting list
+        if vals.get('state') == 'cancelled':
+            if isinstance(ids, (int, long)):
+                ids = [ids]
+            waitlist = self.pool.get('training.waitlist')
+            waitlist.cancel_lines(cr, uid, ids, context=context)
+            if ids and not (context or {}).get('no_waitlist_promotion'):
+                cr.execute("SELECT DISTINCT session_id FROM training_subscription_line "
+                           "WHERE id IN (" + ",".join(['%s'] * len(ids)) + ")", ids)
+                waitlist.promote(cr, uid, [x[0] for x in cr.fetchall() if x[0]], context=context)
+        return res
+
+
+class ParticipationStakeholder:
+    __metaclass__ = PoolMeta
+    __name__ = 'training.participation.stakeholder'
+
+    # The fields booking a lecturer on a seance
+    _lecturer_fields = ('job_id', 'seance_id', 'state')
+
+    def _check_lecturer_conflicts(self, cr, uid, ids, context=None):
+        if not ids:
+            return
+        cr.execute("SELECT DISTINCT seance_id FROM training_participation_stakeholder "
+                   "WHERE seance_id IS NOT NULL "
+                   "AND id IN (" + ",".join(['%s'] * len(ids)) + ")", ids)
+        seance_ids = [x[0] for x in cr.fetchall()]
+        if seance_ids and not self.pool.get('training.seance')._check_lecturer_conflicts(cr, uid, seance_ids, context=context):
+            raise osv.except_osv(_('Warning'), _("A lecturer is already booked on an overlapping seance"))
+
+    # The seances marked by the store triggers are recomputed once when
+    # the transaction commits
+    def create(self, cr, uid, vals, context=None):
+        res = super(ParticipationStakeholder, self).create(cr, uid, vals, context=context)
+        self._check_lecturer_conflicts(cr, uid, [res], context=context)
+        return res
+
+    def write(self, cr, uid, ids, vals, context=None):
+        res = super(ParticipationStakeholder, self).write(cr, uid, ids, vals, context=context)
+        if any(x in vals for x in self._lecturer_fields):
+            if isinstance(ids, (int, long)):
+                ids = [ids]
+            self._check_lecturer_conflicts(cr, uid, ids, context=context)
+        return res
+
+
+class Location:
+    __metaclass__ = PoolMeta
+    __name__ = 'stock.location'
+
+    @classmethod
+    def create(cls, vlist):
+        _internal_location_cache.clear()
+        return super(Location, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        _internal_location_cache.clear()
+        super(Location, cls).write(*args)
+
+    @classmethod
+    def delete(cls, locations):
+        _internal_location_cache.clear()
+        super(Location, cls).delete(locations)